@@ -6,7 +6,7 @@
 # Thanks to: Zotan (https://github.com/zotanwolf), HE (Discord: HE#4681), Liam (Discord: Liam#7089)
 # Modified Date: 2018-07-06
 # Purpose: Prints info for game titles, downloads title files, repacks files into installable NSP. Uses Nintendo CDN.
-# Requirements: requests, tqdm, pyopenssl
+# Requirements: requests, pyopenssl
 
 import os, sys
 import subprocess
@@ -15,14 +15,66 @@ import urllib3
 import json
 import shutil
 import argparse
+import csv
 import configparser
 from hashlib import sha256
-from struct import pack as pk, unpack as upk
+from struct import pack as pk, unpack as upk, pack_into as pk_into, unpack_from as upk_from, iter_unpack as iter_upk
 from binascii import hexlify as hx, unhexlify as uhx
 import xml.etree.ElementTree as ET, xml.dom.minidom as minidom
 import re 
+import threading
+import queue
+import mmap
+import time
+import random
+import contextlib
+import contextvars
+import inspect
+import socket
+import socketserver
+import signal
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import ssl
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, as_completed
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError: # CNMTs will be decrypted with hactool instead
+    Cipher = None
+try:
+    import sqlite3
+except ImportError: # Title info is then always looked up on the CDN
+    sqlite3 = None
 
-title_name = ''
+hashCache = {}
+memCache = OrderedDict()
+memCacheSize = 0
+diskCacheSize = None # Bytes in the cache folder, an upper bound between scans
+cacheLock = threading.RLock()
+versionIndex = (None, {})
+ncaKeys = None
+ncaKeysLock = threading.Lock()
+hashCacheLock = threading.Lock()
+storeRefsLock = threading.Lock()
+FICLONERANGE = 0x4020940d # _IOW(0x94, 13, struct file_clone_range)
+ncaSections = ['exefs', 'romfs', 'section0', 'section1', 'section2', 'section3', 'header']
+sessions = {}
+sessionsLock = threading.Lock()
+hostPools = {} # CDN host -> host_pool of the equivalent hosts its content is fetched from
+regionPool = None
+titleCatalog = None
+connSlots = None # Semaphore or adaptive_limiter bounding the downloads streaming at once, across all titles
+bandwidth = None # rate_limiter shared by every download
+stats = None     # run_stats of this run, set by main
+reporter = None  # progress_reporter drawing the downloads in progress, set by main
+activeClient = None # client the globals above belong to, until it is closed
+currentTitle = contextvars.ContextVar('currentTitle', default='') # Title the timings of a thread are attributed to
+currentJob = contextvars.ContextVar('currentJob', default=None)   # daemon_job the output of a thread belongs to
 
 def read_at(f, off, len):
     f.seek(off)
@@ -68,7 +120,47 @@ def load_config(fPath):
                  'Region':      'US',
                  'Firmware':    '5.1.0-0',
                  'DeviceID':    '0000000000000000',
-                 'Environment': 'lp1'}}
+                 'Environment': 'lp1'},
+              'Download': {
+                 'Workers':     1,
+                 'Segments':    1,
+                 'SegmentSize': 64,
+                 'MaxConnections': 0,
+                 'Adaptive':    False,
+                 'Retries':     3,
+                 'RateLimit':   0,
+                 'BufferSize':  1024,
+                 'WriteBuffers': 4},
+              'Batch': {
+                 'Titles':      1},
+              'Network': {
+                 'PoolMaxSize': 16,
+                 'PoolBlock':   False,
+                 'Endpoints':   {},
+                 'Mirrors':     {},
+                 'Timeout':     30,
+                 'ProbeInterval': 300,
+                 'Cooldown':    30},
+              'Cache': {
+                 'Enabled':        True,
+                 'Path':           'cache',
+                 'MaxSize':        64,
+                 'VersionlistTTL': 3600,
+                 'ShogunTTL':      86400,
+                 'SysUpdateTTL':   600},
+              'Store': {
+                 'Enabled':     False,
+                 'Path':        'store'},
+              'Catalog': {
+                 'Path':        'catalog.db'},
+              'Metrics': {
+                 'Log':         '',
+                 'Textfile':    ''},
+              'Progress': {
+                 'Mode':        'auto',
+                 'Interval':    0.5},
+              'Daemon': {
+                 'Listen':      '127.0.0.1:8765'}}
     try:
         f = open(fPath, 'r')
     except FileNotFoundError:
@@ -78,20 +170,444 @@ def load_config(fPath):
     j = json.load(f)
     
     for key1 in config:
-        for key2 in j[key1]:
+        for key2 in j.get(key1, {}): # Older config files may lack newer sections
             config[key1].update({key2: j[key1][key2]})
             
-    hactoolPath  = j['Paths']['hactoolPath']
-    keysPath     = j['Paths']['keysPath']
-    NXclientPath = j['Paths']['NXclientPath']
-    ShopNPath    = j['Paths']['ShopNPath']
+    hactoolPath  = config['Paths']['hactoolPath']
+    keysPath     = config['Paths']['keysPath']
+    NXclientPath = config['Paths']['NXclientPath']
+    ShopNPath    = config['Paths']['ShopNPath']
     
-    reg          = j['Values']['Region']
-    fw           = j['Values']['Firmware']
-    did          = j['Values']['DeviceID']
-    env          = j['Values']['Environment']
+    reg          = config['Values']['Region']
+    fw           = config['Values']['Firmware']
+    did          = config['Values']['DeviceID']
+    env          = config['Values']['Environment']
     
-    return hactoolPath, keysPath, NXclientPath, ShopNPath, reg, fw, did, env
+    return hactoolPath, keysPath, NXclientPath, ShopNPath, reg, fw, did, env, config
+
+class run_stats:
+    # Per-title timers and byte counters for every phase (head, ttfb, transfer, verify, decrypt, xml, repack, retry)
+    def __init__(self, logPath='', textfilePath=''):
+        self.lock = threading.Lock()
+        self.textfilePath = textfilePath
+        self.phases = OrderedDict() # (title, phase) -> [events, seconds, bytes]
+        self.spans = OrderedDict()  # title -> [first start, last end]
+        self.log = open(logPath, 'a') if logPath != '' else None
+        
+    def record(self, phase, seconds, nbytes=0, **fields):
+        title = currentTitle.get()
+        end = time.time()
+        with self.lock:
+            entry = self.phases.setdefault((title, phase), [0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] += nbytes
+            span = self.spans.setdefault(title, [end-seconds, end])
+            span[0] = min(span[0], end-seconds)
+            span[1] = max(span[1], end)
+            if self.log is not None:
+                fields.update(time=round(end, 6), title=title, phase=phase, seconds=round(seconds, 6), bytes=nbytes)
+                self.log.write(json.dumps(fields) + '\n')
+                self.log.flush()
+    
+    def totals(self, title):
+        totals = {}
+        for (t, phase), entry in self.phases.items():
+            if t == title:
+                totals[phase] = entry
+        return totals
+    
+    def summary(self):
+        titles = [title for title in self.spans if title != '']
+        if titles == []:
+            return
+        print('\nSummary:')
+        for title in titles:
+            totals = self.totals(title)
+            nbytes = totals.get('transfer', [0, 0, 0])[2]
+            seconds = self.spans[title][1] - self.spans[title][0]
+            requests = totals.get('head', [0])[0] + totals.get('ttfb', [0])[0]
+            print('\t%s: %s in %.3fs (%.1f MB/s), %s requests, %s retries' % (title, bytes2human(nbytes), seconds,
+                  nbytes / seconds / 1e6 if seconds else 0, requests, totals.get('retry', [0])[0]))
+            print('\t\t%s' % ', '.join('%s %.3fs' % (phase, totals[phase][1]) for phase in totals if phase != 'retry'))
+    
+    def write_textfile(self, fPath):
+        # Prometheus textfile collector format, replaced atomically so a scrape never sees half a file
+        lines = []
+        for name, n, help in [('cdnsp_phase_events_total', 0, 'Number of timed events per title and phase.'),
+                              ('cdnsp_phase_seconds_total', 1, 'Seconds spent per title and phase.'),
+                              ('cdnsp_phase_bytes_total', 2, 'Bytes handled per title and phase.')]:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s counter' % name)
+            for (title, phase), entry in self.phases.items():
+                lines.append('%s{title="%s",phase="%s"} %s' % (name, title, phase, entry[n]))
+        lines.append('# HELP cdnsp_title_seconds Wall time from the first to the last event of a title.')
+        lines.append('# TYPE cdnsp_title_seconds gauge')
+        for title, span in self.spans.items():
+            lines.append('cdnsp_title_seconds{title="%s"} %s' % (title, span[1]-span[0]))
+        with open(fPath + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(fPath + '.tmp', fPath)
+    
+    def finish(self):
+        self.summary()
+        if self.textfilePath != '':
+            self.write_textfile(self.textfilePath)
+        if self.log is not None:
+            self.log.close()
+
+def record(phase, seconds, nbytes=0, **fields):
+    if stats is not None:
+        stats.record(phase, seconds, nbytes, **fields)
+
+class progress_task:
+    # Byte counter of one download, the only thing the download loop touches
+    def __init__(self, name, total, done=0):
+        self.name = name
+        self.total = total
+        self.done = done
+        self.lock = threading.Lock()
+
+    def update(self, n):
+        with self.lock:
+            self.done += n
+
+class progress_console:
+    # Stands in for sys.stdout while bars are drawn, so prints from any thread land above them
+    def __init__(self, reporter, out):
+        self.reporter = reporter
+        self.out = out
+
+    def write(self, text):
+        return self.reporter.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self.out, name)
+
+class progress_reporter(threading.Thread):
+    # Redraws every download in progress at a fixed rate, either as bars on stdout or as JSON lines on stderr
+    maxLines = 8
+
+    def __init__(self, mode='bars', interval=0.5):
+        threading.Thread.__init__(self, daemon=True)
+        self.mode = mode
+        self.interval = interval
+        self.out = sys.stdout if mode == 'bars' else sys.stderr
+        self.lock = threading.RLock()
+        self.stopped = threading.Event()
+        self.tasks = []
+        self.finished = [0, 0] # Bytes done and expected of the downloads that are over
+        self.rates = {}        # task -> [bytes done at the last redraw, smoothed rate]
+        self.rate = [0, 0.0]
+        self.last = time.monotonic()
+        self.lines = 0         # Lines of the block currently on screen
+        self.partial = False   # Last write didn't end its line, drawing now would cut it
+        self.changed = False
+
+    def add(self, task):
+        with self.lock:
+            self.tasks.append(task)
+            self.rates[task] = [task.done, 0.0]
+            self.changed = True
+
+    def remove(self, task):
+        with self.lock:
+            self.tasks.remove(task)
+            del self.rates[task]
+            self.finished[0] += task.done
+            self.finished[1] += max(task.total, task.done)
+            self.changed = True
+
+    def write(self, text):
+        with self.lock:
+            self.clear()
+            n = self.out.write(text)
+            self.out.flush()
+            if text != '':
+                self.partial = not text.endswith('\n')
+            return n
+
+    def clear(self):
+        if self.lines > 1:
+            self.out.write('\r\x1b[%sA\x1b[J' % (self.lines-1))
+        elif self.lines == 1:
+            self.out.write('\r\x1b[J')
+        self.lines = 0
+
+    def start(self):
+        if self.mode == 'bars':
+            sys.stdout = progress_console(self, self.out)
+        threading.Thread.start(self)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        with self.lock:
+            if self.mode == 'json' and self.changed:
+                self.emit(self.snapshot())
+            self.clear()
+            self.out.flush()
+        if self.mode == 'bars':
+            sys.stdout = self.out
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                view = self.snapshot()
+                if self.mode == 'json':
+                    if self.tasks != [] or self.changed:
+                        self.emit(view)
+                elif not self.partial:
+                    self.draw(view)
+                self.changed = False
+
+    def snapshot(self):
+        # Rates are smoothed over the last few redraws, a single interval is too noisy for an ETA
+        now = time.monotonic()
+        elapsed = max(now - self.last, 1e-6)
+        self.last = now
+        files = []
+        done, total = self.finished
+        for task in self.tasks:
+            sample = self.rates[task]
+            fileDone = task.done
+            sample[1] = 0.7*sample[1] + 0.3*(fileDone - sample[0])/elapsed if sample[1] else (fileDone - sample[0])/elapsed
+            sample[0] = fileDone
+            files.append((task.name, fileDone, task.total, sample[1]))
+            done += fileDone
+            total += max(task.total, fileDone)
+        self.rate[1] = 0.7*self.rate[1] + 0.3*(done - self.rate[0])/elapsed if self.rate[1] else max(done - self.rate[0], 0)/elapsed
+        self.rate[0] = done
+        return files, done, total, self.rate[1]
+
+    def emit(self, view):
+        files, done, total, rate = view
+        line = {'time': round(time.time(), 3), 'done': done, 'total': total, 'rate': round(rate),
+                'eta': round((total-done)/rate, 1) if rate > 0 else None,
+                'downloads': [{'file': name, 'done': fileDone, 'total': fileTotal, 'rate': round(fileRate),
+                               'eta': round((fileTotal-fileDone)/fileRate, 1) if fileRate > 0 else None}
+                              for name, fileDone, fileTotal, fileRate in files]}
+        self.out.write(json.dumps(line) + '\n')
+        self.out.flush()
+
+    def draw(self, view):
+        files, done, total, rate = view
+        width = shutil.get_terminal_size().columns - 1 # Wrapped lines would throw the clearing off
+        lines = []
+        for name, fileDone, fileTotal, fileRate in files[:self.maxLines]:
+            lines.append(self.bar_line(name, fileDone, fileTotal, fileRate))
+        if len(files) > self.maxLines:
+            lines.append('  ... and %s more' % (len(files) - self.maxLines))
+        if files != []:
+            lines.append(self.bar_line('Total (%s)' % len(files), done, total, rate))
+        self.clear()
+        self.out.write('\n'.join(line[:width] for line in lines))
+        self.out.flush()
+        self.lines = len(lines)
+
+    def bar_line(self, name, done, total, rate):
+        filled = int(12 * done / total) if total else 12
+        eta = time.strftime('%H:%M:%S', time.gmtime((total-done)/rate)) if rate > 0 and done < total else '--:--:--'
+        size = lambda n: bytes2human(n, '%(value).1f%(symbol)s')
+        return '%-20s [%s%s] %5.1f%% %7s/%-7s %7s/s %s' % (name[:20], '=' * filled, ' ' * (12-filled),
+               100 * done / total if total else 100, size(done), size(total), size(rate), eta)
+
+def track(name, total, done=0):
+    task = progress_task(name, total, done)
+    if reporter is not None:
+        reporter.add(task)
+    return task
+
+def untrack(task):
+    if reporter is not None:
+        reporter.remove(task)
+
+class cert_adapter(requests.adapters.HTTPAdapter):
+    # Loads the client certificate once and hands the same SSL context to every pooled connection
+    def __init__(self, certificate, **kwargs):
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.context.check_hostname = False
+        self.context.verify_mode = ssl.CERT_NONE
+        self.context.load_cert_chain(certificate)
+        super().__init__(**kwargs)
+        
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['ssl_context'] = self.context
+        return super().init_poolmanager(*args, **kwargs)
+
+def get_session(url, certificate):
+    host = urlsplit(url).netloc
+    with sessionsLock:
+        if (host, certificate) not in sessions:
+            # atum/atumn/tagaya/bugyo/sun each get their own keep-alive pool per certificate
+            adapter = cert_adapter(certificate, pool_connections=1,
+                                   pool_maxsize=config['Network']['PoolMaxSize'],
+                                   pool_block=config['Network']['PoolBlock'])
+            s = requests.Session()
+            s.mount('https://', adapter)
+            s.mount('http://', adapter)
+            sessions[(host, certificate)] = s
+        return sessions[(host, certificate)]
+
+def endpoint_url(url):
+    # Endpoints in the config file send a CDN host's requests elsewhere (a mirror, a proxy, benchmark.py's mock CDN)
+    parts = urlsplit(url)
+    base = config['Network']['Endpoints'].get(parts.netloc)
+    if base is None:
+        return url
+    return base.rstrip('/') + url[len('%s://%s' % (parts.scheme, parts.netloc)):]
+
+def send_request(method, url, certificate, headers):
+    url = endpoint_url(url)
+    timeout = config['Network']['Timeout'] or None # A stalled edge raises instead of hanging the download
+    start = time.perf_counter()
+    r = get_session(url, certificate).request(method, url, headers=headers, verify=False, stream=True, timeout=timeout)
+    # Streamed requests return once the headers are in, so for GETs this is the time to first byte
+    record('head' if method == 'HEAD' else 'ttfb', time.perf_counter() - start, host=urlsplit(url).netloc, status=r.status_code)
+    
+    if method == 'HEAD':
+        r.content # Nothing to read, but this hands the connection back to the pool
+    return r
+
+def failing(status):
+    # Statuses another host might answer better
+    return status == 403 or status == 429 or status >= 500
+
+class host_pool:
+    # Equivalent base URLs the content of a CDN host can be fetched from: the host itself, other edges, mirrors,
+    # a caching proxy. Each base gets a latency, from concurrent HEADs every ProbeInterval and then from a moving
+    # average of its response times, and is benched for Cooldown seconds (doubling up to 32 times as long) when it
+    # fails. Requests go to a healthy base picked at random, weighted by how fast it answers, so NCAs and
+    # segments spread over every base that keeps up, and a request a base fails is sent to the next one.
+    # A 404 from a mirror or proxy isn't taken as final: the other bases are asked, then the CDN host itself.
+    def __init__(self, bases, primary):
+        self.bases = [base.rstrip('/') for base in bases]
+        self.primary = primary
+        self.latency = dict.fromkeys(self.bases)
+        self.failures = dict.fromkeys(self.bases, 0)
+        self.benched = dict.fromkeys(self.bases, 0.0)
+        self.probed = None
+        self.lock = threading.Lock()
+    
+    def probe(self, path, certificate, headers):
+        def head(base):
+            start = time.perf_counter()
+            try:
+                r = send_request('HEAD', base + path, certificate, headers)
+            except requests.exceptions.RequestException as e:
+                return base, None, type(e).__name__
+            return base, time.perf_counter() - start, 'status %s' % r.status_code if failing(r.status_code) else None
+        
+        for base, seconds, error in region_pool().map(head, self.bases):
+            if error is None:
+                self.responded(base, seconds, probe=True)
+                record('probe', seconds, host=base)
+            else:
+                self.failed(base, error)
+    
+    def due(self):
+        # Only the first caller after ProbeInterval probes, the others carry on with the latencies they have
+        now = time.monotonic()
+        with self.lock:
+            if len(self.bases) < 2 or self.probed is not None and now - self.probed < config['Network']['ProbeInterval']:
+                return False
+            self.probed = now
+            return True
+    
+    def choose(self, exclude=()):
+        now = time.monotonic()
+        with self.lock:
+            bases = [base for base in self.bases if base not in exclude]
+            healthy = [base for base in bases if self.benched[base] <= now]
+            if healthy == []: # Every base failed lately, the one back soonest is tried anyway
+                return min(bases, key=self.benched.get)
+            known = [self.latency[base] for base in healthy if self.latency[base] is not None]
+            best = min(known) if known else 1.0 # Bases never heard from count as the fastest, so they get tried
+            weights = [1 / max(0.001, best if self.latency[base] is None else self.latency[base]) for base in healthy]
+            return random.choices(healthy, weights)[0]
+    
+    def healthy(self):
+        now = time.monotonic()
+        with self.lock:
+            return sum(1 for base in self.bases if self.benched[base] <= now)
+    
+    def responded(self, base, seconds, probe=False):
+        with self.lock:
+            latency = self.latency[base]
+            self.latency[base] = seconds if latency is None or probe else 0.8*latency + 0.2*seconds
+            self.failures[base] = 0
+            self.benched[base] = 0.0
+    
+    def failed(self, base, reason):
+        with self.lock:
+            self.failures[base] += 1
+            cooldown = config['Network']['Cooldown'] * 2**min(self.failures[base]-1, 5)
+            self.benched[base] = time.monotonic() + cooldown
+        record('failover', 0, host=base, reason=reason, failures=self.failures[base])
+        if len(self.bases) > 1:
+            print('\t\t%s failed (%s), benched for %ss' % (base, reason, cooldown))
+    
+    def request(self, method, path, certificate, headers):
+        if self.due():
+            self.probe(path, certificate, headers)
+        tried = []
+        while True:
+            base = self.choose(tried)
+            tried.append(base)
+            last = len(tried) == len(self.bases)
+            try:
+                r = send_request(method, base + path, certificate, headers)
+            except requests.exceptions.RequestException as e:
+                self.failed(base, type(e).__name__)
+                if last:
+                    raise
+                continue
+            if r.status_code == 404 and base != self.primary and (not last or self.primary not in tried):
+                r.close() # Not benched, it may well have everything else
+                record('failover', 0, host=base, reason='status 404')
+                if not last:
+                    continue
+                return send_request(method, self.primary + path, certificate, headers)
+            elif failing(r.status_code):
+                self.failed(base, 'status %s' % r.status_code)
+                if not last:
+                    r.close()
+                    continue
+                if r.status_code == 403:
+                    r.close()
+                    raise ValueError('Request rejected by %s! Check your cert.' % base)
+            else:
+                self.responded(base, r.elapsed.total_seconds())
+            r.hostPool, r.base = self, base # For host_failed
+            return r
+    
+    def status(self):
+        now = time.monotonic()
+        with self.lock:
+            return [{'base': base, 'latency': round(self.latency[base], 6) if self.latency[base] is not None else None,
+                     'failures': self.failures[base], 'benched': round(max(0, self.benched[base] - now), 3)}
+                    for base in self.bases]
+
+def host_pool_of(url):
+    # Content hosts (atum, atumn) and hosts with Mirrors in the config file go through a host_pool
+    host = urlsplit(url).netloc
+    with sessionsLock:
+        if host not in hostPools:
+            mirrors = config['Network']['Mirrors'].get(host)
+            if mirrors is None and host.startswith('atum'):
+                mirrors = ['https://' + host]
+            hostPools[host] = host_pool(mirrors, 'https://' + host) if mirrors else None
+        return hostPools[host]
+
+def host_failed(r, reason):
+    # Benches the host r came from, when its body failed after the headers came in fine
+    if getattr(r, 'hostPool', None) is not None:
+        r.hostPool.failed(r.base, reason)
+
+def host_available(url):
+    # Whether a retry of url can go straight to another healthy host instead of backing off
+    pool = host_pool_of(url)
+    return pool is not None and pool.healthy() > 0
 
 def make_request(method, url, certificate='', hdArgs={}):
     if certificate == '': # Workaround for defining errors
@@ -103,176 +619,1738 @@ def make_request(method, url, certificate='', hdArgs={}):
              'Connection': 'keep-alive'}
     reqHd.update(hdArgs)
     
-    r = requests.request(method, url, cert=certificate, headers=reqHd, verify=False, stream=True)
+    pool = host_pool_of(url)
+    if pool is not None: # Content requests fail over to the other hosts
+        parts = urlsplit(url)
+        return pool.request(method, url[len('%s://%s' % (parts.scheme, parts.netloc)):], certificate, reqHd)
     
+    r = send_request(method, url, certificate, reqHd)
     if r.status_code == 403:
-        print('Request rejected by server! Check your cert.')
-        sys.exit()
-
+        r.close()
+        raise ValueError('Request rejected by %s! Check your cert.' % urlsplit(url).netloc)
     return r
     
-def get_info(tid):
-    global title_name
-    print('\n%s:' % tid)
+class rate_limiter:
+    # Token bucket shared by every download thread, rate is in bytes per second
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+        
+    def consume(self, n):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now-self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+def throttle(n):
+    if bandwidth is not None:
+        bandwidth.consume(n)
+
+def connection_slot():
+    return connSlots if connSlots is not None else contextlib.nullcontext()
+
+class adaptive_limiter:
+    # Connection slots whose number is tuned while downloading, AIMD style. Every interval the bytes, times to
+    # first byte and errors of the connections are looked at: errors (dropped connections, 429 and 5xx) halve
+    # the limit and a TTFB well above the lowest seen takes a quarter off it. Otherwise, if every slot was in
+    # use, a slot is added as long as that keeps raising the throughput, and given back when it didn't.
+    interval = 2   # Seconds between decisions
+    hold = 5       # Decisions to wait after giving a slot back before probing again
+    
+    def __init__(self, ceiling, start=4):
+        self.ceiling = ceiling
+        self.limit = min(start, ceiling)
+        self.active = 0
+        self.cond = threading.Condition()
+        self.minTtfb = None
+        self.lastRate = 0.0
+        self.grew = False  # Whether the last decision added a slot
+        self.holding = 0
+        self.reset(time.monotonic())
+    
+    def reset(self, now):
+        self.began = now
+        self.bytes = 0
+        self.errors = 0
+        self.ttfbs = []
+        self.busy = self.active >= self.limit
+    
+    def __enter__(self):
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+            if self.active >= self.limit:
+                self.busy = True
+    
+    def __exit__(self, type, value, tb):
+        with self.cond:
+            self.active -= 1
+            if type is not None and issubclass(type, requests.exceptions.RequestException):
+                self.errors += 1
+            self.cond.notify_all()
+            self.adjust()
+        return False
+    
+    def response(self, seconds):
+        with self.cond:
+            self.ttfbs.append(seconds)
+    
+    def transferred(self, n):
+        with self.cond:
+            self.bytes += n
+            self.adjust()
+    
+    def adjust(self):
+        now = time.monotonic()
+        if now - self.began < self.interval:
+            return
+        rate = self.bytes / (now - self.began)
+        ttfb = sorted(self.ttfbs)[len(self.ttfbs)//2] if self.ttfbs else None
+        if ttfb is not None and (self.minTtfb is None or ttfb < self.minTtfb):
+            self.minTtfb = ttfb
+        
+        limit = self.limit
+        if self.errors:
+            limit, reason = max(1, limit // 2), '%s errors' % self.errors
+        elif ttfb is not None and ttfb > 2*self.minTtfb + 0.1:
+            limit, reason = max(1, limit * 3 // 4), 'time to first byte %.0f ms' % (ttfb * 1000)
+        elif not self.busy or self.holding:
+            self.holding = max(0, self.holding - 1)
+            limit, reason = limit, 'holding' if self.busy else 'idle slots'
+        elif self.grew and rate < self.lastRate * 1.05:
+            limit, reason = limit - 1, 'throughput stopped growing'
+            self.holding = self.hold
+        else:
+            limit, reason = min(self.ceiling, limit + 1), 'probing'
+        
+        record('adapt', now - self.began, self.bytes, limit=limit, previous=self.limit, reason=reason, errors=self.errors,
+               ttfb=round(ttfb, 6) if ttfb is not None else None, rate=round(rate), perConnection=round(rate / self.limit))
+        if limit < self.limit:
+            print('\t\tConnections: %s -> %s (%s)' % (self.limit, limit, reason))
+        self.grew = limit > self.limit
+        self.lastRate = rate
+        self.limit = limit
+        self.reset(now)
+        self.cond.notify_all()
+
+def observe_response(r):
+    if isinstance(connSlots, adaptive_limiter):
+        connSlots.response(r.elapsed.total_seconds())
+
+def observe_transfer(n):
+    if isinstance(connSlots, adaptive_limiter):
+        connSlots.transferred(n)
+
+def backoff(attempt, stop=None):
+    # Sleeps before retry attempt (1, 2, ...) with some jitter, so retried connections don't all come back at once
+    delay = min(8, 0.5 * 2**(attempt-1)) * random.uniform(0.5, 1)
+    if stop is not None and stop.wait(delay):
+        raise InterruptedError('Download aborted!')
+    elif stop is None:
+        time.sleep(delay)
+
+class cached_reply:
+    # Stands in for a requests response for cached_request callers
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+        
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+def cache_dir():
+    dir = config['Cache']['Path']
+    if not os.path.isabs(dir):
+        dir = os.path.join(os.path.dirname(__file__), dir)
+    os.makedirs(dir, exist_ok=True)
+    return dir
+
+def cached_request(url, certificate='', ttl=3600):
+    # GET for metadata (versionlist, shogun, system update meta), kept in memory and on disk.
+    # Entries younger than ttl seconds are used as is, older ones are revalidated with ETag/If-Modified-Since.
+    if config['Cache']['Enabled'] == False:
+        r = make_request('GET', url, certificate)
+        return cached_reply(r.status_code, r.content)
+    
+    key = sha256(('%s %s' % (certificate, url)).encode()).hexdigest()
+    metaPath = os.path.join(cache_dir(), key + '.json')
+    bodyPath = os.path.join(cache_dir(), key + '.body')
     
+    with cacheLock:
+        entry = memCache.get(key)
+        if entry is not None:
+            memCache.move_to_end(key)
+    if entry is None:
+        try:
+            with open(metaPath, 'r') as f:
+                entry = json.load(f)
+            with open(bodyPath, 'rb') as f:
+                entry['body'] = f.read()
+        except (OSError, ValueError):
+            entry = None
+    
+    if entry is not None and time.time() - entry['fetched'] < ttl:
+        remember(key, entry)
+        touch_entry(bodyPath)
+        return cached_reply(200, entry['body'])
+    
+    hdArgs = {}
+    if entry is not None and entry.get('etag'):
+        hdArgs['If-None-Match'] = entry['etag']
+    if entry is not None and entry.get('lastModified'):
+        hdArgs['If-Modified-Since'] = entry['lastModified']
+    r = make_request('GET', url, certificate, hdArgs)
+    
+    if r.status_code == 304 and entry is not None:
+        r.content
+        entry['fetched'] = time.time()
+        touch_entry(bodyPath)
+    elif r.status_code == 200:
+        entry = {'url': url, 'etag': r.headers.get('ETag'), 'lastModified': r.headers.get('Last-Modified'),
+                 'fetched': time.time(), 'body': r.content}
+        with cacheLock:
+            with open(bodyPath + '.tmp', 'wb') as f:
+                f.write(entry['body'])
+            os.replace(bodyPath + '.tmp', bodyPath)
+    else:
+        return cached_reply(r.status_code, r.content) # Errors aren't cached
+    
+    with cacheLock:
+        with open(metaPath + '.tmp', 'w') as f:
+            json.dump({k: v for k, v in entry.items() if k != 'body'}, f)
+        os.replace(metaPath + '.tmp', metaPath)
+    remember(key, entry)
+    evict_cache(len(entry['body']) if r.status_code == 200 else 0)
+    return cached_reply(200, entry['body'])
+
+def touch_entry(bodyPath):
+    # evict_cache goes by the mtime of the bodies, so entries served or revalidated count as recently used
+    try:
+        os.utime(bodyPath)
+    except OSError: # Evicted from disk but still in memory
+        pass
+
+def remember(key, entry):
+    global memCacheSize
+    with cacheLock:
+        if key in memCache:
+            memCacheSize -= len(memCache.pop(key)['body'])
+        memCache[key] = entry
+        memCacheSize += len(entry['body'])
+        while memCacheSize > config['Cache']['MaxSize'] * 0x100000 and len(memCache) > 1:
+            memCacheSize -= len(memCache.popitem(last=False)[1]['body'])
+
+def evict_cache(added=0):
+    # Least recently used entries go first once the folder is over MaxSize. The folder is only
+    # listed when what was written since the last listing could have put it over.
+    global diskCacheSize
+    dir = cache_dir()
+    with cacheLock:
+        if diskCacheSize is not None:
+            diskCacheSize += added
+            if diskCacheSize <= config['Cache']['MaxSize'] * 0x100000:
+                return
+        entries = []
+        for name in os.listdir(dir):
+            if name.endswith('.body'):
+                st = os.stat(os.path.join(dir, name))
+                entries.append((st.st_mtime, st.st_size, name[:-5]))
+        total = sum(size for mtime, size, key in entries)
+        for mtime, size, key in sorted(entries):
+            if total <= config['Cache']['MaxSize'] * 0x100000:
+                break
+            for ext in ['.body', '.json']:
+                try:
+                    os.remove(os.path.join(dir, key + ext))
+                except OSError:
+                    pass
+            total -= size
+        diskCacheSize = total
+
+def region_pool():
+    # Threads the shogun regions of a title are looked up on, shared by every lookup
+    global regionPool
+    with cacheLock:
+        if regionPool is None:
+            regionPool = ThreadPoolExecutor(max_workers=config['Network']['PoolMaxSize'])
+        return regionPool
+
+def get_versionlist(ttl=None):
+    # TitleID -> latest version, rebuilt only when the cached versionlist itself changes
+    global versionIndex
+    if ttl is None:
+        ttl = config['Cache']['VersionlistTTL']
+    url = 'https://tagaya.hac.%s.eshop.nintendo.net/tagaya/hac_versionlist' % env
+    r = cached_request(url, ttl=ttl)
+    with cacheLock:
+        if versionIndex[0] is not r.content:
+            versionIndex = (r.content, {title['id'].lower(): title['version'] for title in r.json()['titles']})
+            if titleCatalog is not None:
+                titleCatalog.store_versions(versionIndex[1])
+        return versionIndex[1]
+
+def latest_version(updateTid):
+    if titleCatalog is not None:
+        found, version = titleCatalog.version(updateTid)
+        if found:
+            return version
+    return get_versionlist().get(updateTid)
+
+def title_ids(tid):
+    # Base game and update TitleIDs of a game, update or DLC
     if tid.endswith('000'):
-        baseTid = tid
-        updateTid = '%s800' % tid[:-3]
+        return tid, '%s800' % tid[:-3]
     elif tid.endswith('800'):
-        baseTid = '%s000' % tid[:-3]
-        updateTid = tid
+        return '%s000' % tid[:-3], tid
     elif not tid.endswith('00'):
-        baseTid = '%016x' % (int(tid, 16) - 0x1000 & 0xFFFFFFFFFFFFF000)
-        updateTid = '%s800' % tid[:-3]
+        return '%016x' % (int(tid, 16) - 0x1000 & 0xFFFFFFFFFFFFF000), '%s800' % tid[:-3]
     else:
-        print('\tInvalid shogun TitleID %s!' % tid)
+        raise ValueError('Invalid shogun TitleID %s!' % tid)
+
+def lookup_title(tid):
+    # Name, size and latest update of a title, without printing anything
+    baseTid, updateTid = title_ids(tid)
+    if titleCatalog is not None:
+        info = titleCatalog.title(tid)
+        if info is not None:
+            info['latestVersion'] = latest_version(updateTid)
+            return info
+    
+    info = {'tid': tid, 'baseTid': baseTid, 'updateTid': updateTid, 'name': None, 'size': None}
+    
+    # The preferred region is asked first, most titles are sold there. The other regions are then asked
+    # all at once, and the first one in order of preference that sells the title wins.
+    regions = list(OrderedDict.fromkeys([reg, 'US', 'EU', 'AU', 'KR', 'TW', 'JP']))
+    def ids(region):
+        url = 'https://bugyo.hac.%s.eshop.nintendo.net/shogun/v1/contents/ids?shop_id=4&lang=en&country=%s&type=title&title_ids=%s'\
+            % (env, region, baseTid)
+        return cached_request(url, certificate=ShopNPath, ttl=config['Cache']['ShogunTTL'])
+    
+    found = None
+    status = 404
+    for batch in [regions[:1], regions[1:]]:
+        futures = [region_pool().submit(contextvars.copy_context().run, ids, region) for region in batch]
+        try:
+            for region, future in zip(batch, futures):
+                r = future.result()
+                if r.status_code == 200 and len(r.json()['id_pairs']):
+                    found = (region, r)
+                    break
+                if r.status_code == 200 and found is None:
+                    found = (region, r) # Not sold there, used if no region sells it
+                elif r.status_code != 404:
+                    status = r.status_code
+        finally:
+            for future in futures:
+                future.cancel()
+        if found is not None and len(found[1].json()['id_pairs']):
+            break
+    if found is None and status == 404:
+        raise FileNotFoundError('File not found on server: 404')
+    elif found is None:
+        raise ValueError('Shogun lookup of %s failed, server returned %s!' % (baseTid, status))
+    region, r = found
+    j = r.json()
+        
+    if len(j['id_pairs']):
+        nsuid = j['id_pairs'][0]['id']
+        url = 'https://bugyo.hac.%s.eshop.nintendo.net/shogun/v1/titles/%s?shop_id=4&lang=en&country=%s' % (env, nsuid, region)
+        r = cached_request(url, certificate=ShopNPath, ttl=config['Cache']['ShogunTTL'])
+        j = r.json()
+        info['name'] = j['formal_name']
+        info['size'] = j.get('total_rom_size')
+    
+    if titleCatalog is not None:
+        titleCatalog.store_title(info)
+    info['latestVersion'] = latest_version(updateTid)
+    return info
+
+def get_info(tid):
+    print('\n%s:' % tid)
+    try:
+        info = lookup_title(tid)
+    except FileNotFoundError:
+        raise FileNotFoundError('%s was not found on shogun in any region!' % tid)
+    except ValueError as e:
+        print('\t%s' % e)
+        return 'Unknown'
+    
+    print_info(info)
+    return info['name'] if info['name'] is not None else 'Unknown'
+
+def print_info(info):
+    if info['name'] is not None:
+        print('\tName: %s' % info['name'])
+        if info['size'] is not None:
+            print('\tSize: %s' % bytes2human(info['size']))
+        else:
+            print('\t\tNo size was found for %s' % info['tid'])
+        print('\tBase TID:   %s' % info['baseTid'])
+        print('\tUpdate TID: %s' % info['updateTid'])
+    else:
+        print('\tCan\'t get name of title, TitleID not found on Shogun!')
+    
+    lastestVer = info['latestVersion']
+    if lastestVer is not None:
+        print('\tAvailable update versions for %s:' % info['updateTid'])
+        print('\t\tv%s' % " v".join(str(i) for i in range(0x10000, lastestVer+1, 0x10000)))
+    else:
+        print('\t%s has no update available!' % info['updateTid'])
+
+def bulk_info(tids, workers=16, done=None):
+    # lookup_title for every TID, workers at a time. Failures are recorded in the 'error' of their
+    # TID instead of stopping the run, results come back in the order of tids and are also handed
+    # to done as soon as they and those before them are in.
+    def lookup(tid):
+        try:
+            if len(tid) != 16 or re.match('^[0-9a-f]+$', tid) is None:
+                raise ValueError('TitleID %s is not a 16-digits hexadecimal number!' % tid)
+            info = lookup_title(tid)
+            info['error'] = None
+        except Exception as e:
+            info = {'tid': tid, 'baseTid': None, 'updateTid': None, 'name': None, 'size': None, 'latestVersion': None,
+                    'error': str(e) or type(e).__name__}
+        return info
+    
+    start = time.perf_counter()
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for info in pool.map(lambda tid: contextvars.copy_context().run(lookup, tid), tids):
+            results.append(info)
+            if done is not None:
+                done(info)
+    record('info', time.perf_counter() - start, titles=len(tids))
+    return results
+
+def read_tids(fPath):
+    # One TitleID per line, blank lines and # comments are skipped
+    tids = []
+    with open(fPath, 'r') as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if line != '':
+                tids.append(line.lower())
+    return tids
+
+def write_info(results, fPath):
+    # JSON array, or CSV if fPath ends with .csv
+    with open(fPath + '.tmp', 'w', newline='') as f:
+        if fPath.lower().endswith('.csv'):
+            writer = csv.DictWriter(f, fieldnames=['tid', 'name', 'size', 'baseTid', 'updateTid', 'latestVersion', 'error'])
+            writer.writeheader()
+            writer.writerows(results)
+        else:
+            json.dump(results, f, indent=1)
+    os.replace(fPath + '.tmp', fPath)
+
+class title_catalog:
+    # SQLite copy of the versionlist and of what shogun said about every title looked up, so title info and
+    # latest versions are answered by indexed lookups. Versions are trusted for VersionlistTTL after they
+    # were last synced, titles shogun didn't know are asked about again once ShogunTTL runs out.
+    def __init__(self, fPath):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(fPath, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS titles (tid TEXT PRIMARY KEY, baseTid TEXT NOT NULL, updateTid TEXT NOT NULL,
+                                               name TEXT, size INTEGER, checked REAL NOT NULL) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS titlesByBase ON titles (baseTid);
+            CREATE TABLE IF NOT EXISTS versions (updateTid TEXT PRIMARY KEY, baseTid TEXT NOT NULL, version INTEGER NOT NULL) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value) WITHOUT ROWID;''')
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'versionsSynced'").fetchone()
+        self.synced = row[0] if row is not None else 0
+        self.changes = (0, 0) # Versions written and removed by the last store_versions
+    
+    def title(self, tid):
+        # Shogun is asked about the game, so its update and DLC are answered from its row
+        baseTid, updateTid = title_ids(tid)
+        with self.lock:
+            row = self.db.execute('SELECT name, size, checked FROM titles WHERE tid = ?', (baseTid,)).fetchone()
+        if row is None or row[0] is None and time.time() - row[2] > config['Cache']['ShogunTTL']:
+            return None
+        if tid != baseTid:
+            with self.lock, self.db:
+                self.db.execute('INSERT OR IGNORE INTO titles VALUES (?, ?, ?, ?, ?, ?)', (tid, baseTid, updateTid, row[0], row[1], row[2]))
+        return {'tid': tid, 'baseTid': baseTid, 'updateTid': updateTid, 'name': row[0], 'size': row[1]}
+    
+    def store_title(self, info):
+        # A row for the game and one for the update or DLC looked up, which is what links them
+        now = time.time()
+        with self.lock, self.db:
+            for tid, updateTid in OrderedDict([(info['baseTid'], title_ids(info['baseTid'])[1]), (info['tid'], info['updateTid'])]).items():
+                self.db.execute('INSERT OR REPLACE INTO titles VALUES (?, ?, ?, ?, ?, ?)',
+                                (tid, info['baseTid'], updateTid, info['name'], info['size'], now))
+            self.db.execute('UPDATE titles SET name = ?, size = ?, checked = ? WHERE baseTid = ?',
+                            (info['name'], info['size'], now, info['baseTid']))
+    
+    def version(self, updateTid):
+        # (found, latest version), nothing is found once the versions are older than VersionlistTTL
+        if time.time() - self.synced > config['Cache']['VersionlistTTL']:
+            return False, None
+        with self.lock:
+            row = self.db.execute('SELECT version FROM versions WHERE updateTid = ?', (updateTid,)).fetchone()
+        return True, row[0] if row is not None else None
+    
+    def store_versions(self, index):
+        # Only the versions that changed since the last sync are written
+        with self.lock, self.db:
+            old = dict(self.db.execute('SELECT updateTid, version FROM versions'))
+            changed = []
+            for updateTid, version in index.items():
+                if old.get(updateTid) != version and updateTid.endswith('800'):
+                    changed.append((updateTid, title_ids(updateTid)[0], version))
+            removed = [(updateTid,) for updateTid in old if updateTid not in index]
+            self.db.executemany('INSERT OR REPLACE INTO versions VALUES (?, ?, ?)', changed)
+            self.db.executemany('DELETE FROM versions WHERE updateTid = ?', removed)
+            self.synced = time.time()
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('versionsSynced', ?)", (self.synced,))
+            self.changes = (len(changed), len(removed))
+    
+    def unnamed(self):
+        # Games of the versionlist shogun wasn't asked about yet, or didn't know the last time it was asked
+        with self.lock:
+            return [row[0] for row in self.db.execute('''
+                SELECT DISTINCT versions.baseTid FROM versions LEFT JOIN titles ON titles.tid = versions.baseTid
+                WHERE titles.tid IS NULL OR titles.name IS NULL AND titles.checked < ? ORDER BY versions.baseTid''',
+                (time.time() - config['Cache']['ShogunTTL'],))]
+    
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+def sync_catalog(workers=16):
+    # The versionlist is revalidated and diffed into the catalog, then shogun is only asked about the games
+    # the catalog has no name for. Returns the number of games whose lookup failed.
+    global versionIndex
+    print('Syncing title catalog...')
+    with cacheLock:
+        versionIndex = (None, {}) # Stored again even if the versionlist didn't change, which marks it synced
+    get_versionlist(ttl=0)
+    print('\tVersionlist: %s versions new or changed, %s removed' % titleCatalog.changes)
+    
+    tids = titleCatalog.unnamed()
+    results = bulk_info(tids, workers)
+    failed = sum(info['error'] is not None for info in results)
+    print('\tShogun: looked up %s titles, %s named, %s failed' % (len(tids), sum(info['name'] is not None for info in results), failed))
+    return failed
+
+def file_sha256(fPath):
+    # Digests recorded while downloading are reused as long as the file hasn't changed since,
+    # from memory or, in later runs, from the .sha256 file download_file left next to it
+    st = os.stat(fPath)
+    key = os.path.realpath(fPath)
+    with hashCacheLock:
+        cached = hashCache.get(key)
+    if cached is None:
+        try:
+            with open(fPath + '.sha256', 'r') as f:
+                j = json.load(f)
+            cached = (j['size'], j['mtime'], j['sha256'])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    if cached is not None and tuple(cached[:2]) == (st.st_size, st.st_mtime_ns):
+        return store_hash(fPath, cached[2])
+    
+    return store_hash(fPath, hash_range(fPath, 0, st.st_size).hexdigest())
+
+def hash_range(fPath, offset, size, hash=None):
+    if hash is None:
+        hash = sha256()
+    with open(fPath, 'rb') as f:
+        f.seek(offset)
+        while size > 0:
+            buf = f.read(min(size, 0x100000))
+            if not buf:
+                break
+            hash.update(buf)
+            size -= len(buf)
+    return hash
+
+def store_hash(fPath, digest):
+    st = os.stat(fPath)
+    with hashCacheLock:
+        hashCache[os.path.realpath(fPath)] = (st.st_size, st.st_mtime_ns, digest)
+    return digest
+
+def check_hash(fPath, digest, expHash):
+    # expHash is either a full SHA-256 from the CNMT or a content ID, which is the first half of it
+    if expHash != '' and digest[:len(expHash)] != expHash.lower():
+        os.remove(fPath)
+        raise ValueError('%s is corrupted, its SHA-256 (%s) does not match the CNMT (%s)!'
+                         % (os.path.basename(fPath), digest, expHash))
+    return store_hash(fPath, digest)
+
+def preallocate(f, offset, size):
+    # Reserves the blocks up front, so the file isn't fragmented and a full disk fails right away
+    if size > 0 and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), offset, size)
+        except OSError: # Not supported by this filesystem
+            pass
+
+class disk_writer(threading.Thread):
+    # Writes (and hashes) the buffers a download reads, so a slow disk doesn't hold up the socket.
+    # Buffers go back to a free list once written, so a download only ever allocates buffers+1 of them.
+    def __init__(self, f, hash=None, wrote=None, buffers=4, bufSize=0x100000):
+        super().__init__(daemon=True)
+        self.f = f
+        self.hash = hash
+        self.wrote = wrote
+        self.error = None
+        self.free = queue.Queue()
+        for n in range(buffers+1):
+            self.free.put(bytearray(bufSize))
+        self.full = queue.Queue(maxsize=buffers)
+        self.start()
+        
+    def run(self):
+        while True:
+            item = self.full.get()
+            if item is None:
+                return
+            buf, n = item
+            if self.error is None:
+                try:
+                    view = memoryview(buf)[:n]
+                    self.f.write(view)
+                    if self.hash is not None:
+                        self.hash.update(view) # hashlib releases the GIL on large buffers
+                    if self.wrote is not None:
+                        self.wrote(n)
+                    view.release()
+                except BaseException as e:
+                    self.error = e
+            if isinstance(buf, bytearray): # Decoded chunks (bytes) aren't reused
+                self.free.put(buf)
+    
+    def buffer(self):
+        return self.free.get()
+    
+    def put(self, buf, n):
+        if self.error is not None:
+            raise self.error
+        self.full.put((buf, n))
+        
+    def close(self):
+        self.full.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+def stream_body(r, f, size, fName='', stop=None, hash=None, wrote=None, progress=None):
+    # Reads up to size bytes of a streamed response into large reusable buffers, a disk_writer
+    # puts them in f at its current position. wrote is called with what reached f, progress with what was read.
+    bufSize = config['Download']['BufferSize'] * 1024
+    writer = disk_writer(f, hash, wrote, config['Download']['WriteBuffers'], bufSize)
+    read = 0
+    try:
+        if r.headers.get('Content-Encoding', 'identity') == 'identity':
+            while read < size:
+                if stop is not None and stop.is_set():
+                    raise InterruptedError('Download of %s aborted!' % fName)
+                buf = writer.buffer()
+                try:
+                    n = r.raw.readinto(memoryview(buf)[:min(bufSize, size-read)])
+                except urllib3.exceptions.ProtocolError as e: # Raised the way iter_content would
+                    raise requests.exceptions.ChunkedEncodingError(e)
+                except urllib3.exceptions.ReadTimeoutError as e:
+                    raise requests.exceptions.ConnectionError(e)
+                if n == 0:
+                    writer.free.put(buf)
+                    break
+                writer.put(buf, n)
+                read += n
+                throttle(n)
+                observe_transfer(n)
+                if progress is not None:
+                    progress(n)
+        else: # The server compressed the body anyway, so requests has to decode it
+            for chunk in r.iter_content(bufSize):
+                if stop is not None and stop.is_set():
+                    raise InterruptedError('Download of %s aborted!' % fName)
+                writer.put(chunk, len(chunk))
+                read += len(chunk)
+                throttle(len(chunk))
+                observe_transfer(len(chunk))
+                if progress is not None:
+                    progress(len(chunk))
+    finally:
+        writer.close()
+    return read
+
+class part_file:
+    # A download in progress. fPath.part is preallocated to the full size and gets the data at its final
+    # offsets, fPath.journal records the expected size and hash, the byte ranges still missing and, for
+    # single streams, the SHA-256 of the prefix on disk. Only a complete, verified file is renamed to fPath.
+    interval = 1 # Seconds between journal updates while downloading
+    
+    def __init__(self, fPath, expHash=''):
+        self.fPath = fPath
+        self.partPath = fPath + '.part'
+        self.journalPath = fPath + '.journal'
+        self.expHash = expHash.lower()
+        self.lock = threading.Lock()
+        self.size = 0
+        self.remaining = []
+        self.prefix = None # [offset, hex digest]
+        self.ranges = []
+        self.done = []
+        self.hash = None
+        self.saved = 0
+    
+    def load(self):
+        try:
+            with open(self.journalPath, 'r') as f:
+                journal = json.load(f)
+        except (FileNotFoundError, ValueError): # No journal, or one cut short by a crash
+            return False
+        if journal.get('hash') != self.expHash or not os.path.exists(self.partPath) or os.path.getsize(self.partPath) != journal.get('size'):
+            return False
+        self.size = journal['size']
+        self.remaining = [tuple(rng) for rng in journal['remaining']]
+        self.prefix = journal.get('prefix')
+        return True
+    
+    def create(self, size, ranges):
+        self.size = size
+        self.remaining = ranges
+        self.prefix = None
+        with open(self.partPath, 'wb') as f:
+            f.truncate(size) # Full size up front so every range can write at its own offset
+            preallocate(f, 0, size)
+        self.save()
+    
+    def resume_hash(self):
+        # hashlib objects can't be saved, so the prefix is hashed again and checked against the digest
+        # recorded with it, which also catches data the journal counted but a crash kept off the disk
+        if len(self.remaining) != 1 or self.remaining[0][1] != self.size-1 or self.prefix is None or self.prefix[0] != self.remaining[0][0]:
+            return None # Ranges land out of order, the file is hashed from disk once complete
+        hash = hash_range(self.partPath, 0, self.prefix[0])
+        if hash.hexdigest() != self.prefix[1]:
+            print('\t\tPartial data does not match the journal, restarting download...')
+            self.remaining = [(0, self.size-1)]
+            return sha256()
+        return hash
+    
+    def follow(self, ranges, done, hash=None):
+        # Ranges being fetched, the bytes of each already on disk and the hash of the prefix, if any
+        self.ranges = ranges
+        self.done = done
+        self.hash = hash
+        if hash is None:
+            self.prefix = None
+    
+    def checkpoint(self, force=False):
+        # Called from the disk writers after every buffer, the hash then covers exactly what is on disk
+        if not force and time.monotonic() - self.saved < self.interval:
+            return
+        with self.lock:
+            self.saved = time.monotonic()
+            self.remaining = [(start+dlded, end) for (start, end), dlded in zip(self.ranges, self.done) if start+dlded <= end]
+            if self.hash is not None and len(self.ranges) == 1:
+                self.prefix = [self.ranges[0][0] + self.done[0], self.hash.copy().hexdigest()]
+            self.save()
+    
+    def save(self):
+        with open(self.journalPath + '.tmp', 'w') as f:
+            json.dump({'size': self.size, 'hash': self.expHash, 'remaining': self.remaining, 'prefix': self.prefix}, f)
+        os.replace(self.journalPath + '.tmp', self.journalPath)
+    
+    def finish(self, hash=None):
+        fName = os.path.basename(self.fPath)
+        if hash is None:
+            start = time.perf_counter()
+            hash = hash_range(self.partPath, 0, self.size)
+            record('verify', time.perf_counter() - start, self.size, file=fName)
+        digest = hash.hexdigest()
+        if self.expHash != '' and digest[:len(self.expHash)] != self.expHash:
+            os.remove(self.partPath)
+            os.remove(self.journalPath)
+            raise ValueError('%s is corrupted, its SHA-256 (%s) does not match the CNMT (%s)!' % (fName, digest, self.expHash))
+        os.replace(self.partPath, self.fPath)
+        os.remove(self.journalPath)
+        st = os.stat(self.fPath)
+        with open(self.fPath + '.sha256', 'w') as f: # Saves rehashing the file when a later run finds it
+            json.dump({'size': st.st_size, 'mtime': st.st_mtime_ns, 'sha256': digest}, f)
+        return store_hash(self.fPath, digest)
+
+def download_file(url, fPath, stop=None, segments=1, segmentSize=0x4000000, expHash=''):
+    fName = os.path.basename(fPath).split()[0]
+    part = part_file(fPath, expHash)
+    
+    if os.path.exists(fPath): # Downloads only get their final name once complete
+        if os.path.exists(part.journalPath): # Crashed between the rename and the cleanup
+            os.remove(part.journalPath)
+        if expHash == '' or file_sha256(fPath)[:len(expHash)] == expHash.lower():
+            print('\t\tDownload is already complete, skipping!')
+            return fPath
+        print('\t\tExisting %s does not match the CNMT, downloading it again...' % fName)
+        os.remove(fPath)
+        if os.path.exists(fPath + '.sha256'):
+            os.remove(fPath + '.sha256')
+    
+    if part.load(): # Everything needed to carry on is in the journal, no probing request
+        print('\t\tResuming download...')
+        record('retry', 0, file=fName, reason='resume')
+        hash = part.resume_hash()
+    elif segments > 1:
+        r = make_request('HEAD', url)
+        fSize = int(r.headers.get('Content-Length', 0))
+        if r.status_code != 200 or fSize < 2*segmentSize: # Small files aren't worth splitting
+            return download_stream(url, part, stop)
+        part.create(fSize, split_range(0, fSize-1, min(segments, fSize//segmentSize)))
+        hash = None
+        print('\t\tFetching %s in %s segments...' % (fName, len(part.remaining)))
+    else:
+        return download_stream(url, part, stop)
+    
+    ranges = part.remaining
+    done = [0] * len(ranges)
+    part.follow(ranges, done, hash)
+    if ranges != []: # Otherwise it crashed right before the rename
+        try:
+            fetch_ranges(url, part.partPath, ranges, fName, stop, done=done, hash=hash, checkpoint=part.checkpoint)
+        finally:
+            part.checkpoint(True)
+    
+    part.finish(hash)
+    print('\t\tSaved to %s!' % fPath)
+    return fPath
+
+def download_stream(url, part, stop=None):
+    # Fresh single-stream download, the size comes from the response itself. What a dropped connection
+    # left out is then fetched as a range, with the hash carrying on from what is on disk.
+    fName = os.path.basename(part.fPath).split()[0]
+    fSize = None
+    done = [0]
+    hash = sha256()
+    def wrote(n):
+        done[0] += n
+        part.checkpoint()
+    
+    attempt = 0
+    while True:
+        r = None
+        try:
+            with connection_slot():
+                r = make_request('GET', url, hdArgs={'Accept-Encoding': 'identity'}) # NCAs are encrypted, compressing them gains nothing
+                observe_response(r)
+                if r.status_code != 200:
+                    r.close()
+                    error = 'Download of %s failed, server returned %s!' % (fName, r.status_code)
+                    if r.status_code == 429 or r.status_code >= 500:
+                        raise requests.exceptions.HTTPError(error, response=r)
+                    raise ValueError(error)
+                fSize = int(r.headers.get('Content-Length'))
+                
+                ranges = [(0, fSize-1)] if fSize else []
+                part.create(fSize, ranges)
+                part.follow(ranges, done, hash)
+                task = track(fName, fSize)
+                start = time.perf_counter()
+                try:
+                    with open(part.partPath, 'r+b') as f:
+                        stream_body(r, f, fSize, fName, stop, hash, wrote, task.update)
+                finally:
+                    r.close()
+                    untrack(task)
+                    part.checkpoint(True)
+                    record('transfer', time.perf_counter() - start, done[0], file=fName)
+            break
+        except requests.exceptions.RequestException as e:
+            if r is not None and r.status_code == 200: # The body failed, the rest comes from another host if there is one
+                host_failed(r, type(e).__name__)
+            attempt += 1
+            if attempt > config['Download']['Retries']:
+                raise
+            record('retry', 0, file=fName, reason=type(e).__name__)
+            if fSize is not None:
+                break
+            print('\t\t%s, retrying (%s/%s)...' % (str(e).rstrip('!'), attempt, config['Download']['Retries']))
+            if not host_available(url):
+                backoff(attempt, stop)
+    
+    if done[0] != fSize:
+        print('\t\tConnection lost, resuming %s at %s...' % (fName, bytes2human(done[0])))
+        ranges = [(done[0], fSize-1)]
+        rest = [0]
+        part.follow(ranges, rest, hash)
+        try:
+            fetch_ranges(url, part.partPath, ranges, fName, stop, done=rest, hash=hash, checkpoint=part.checkpoint)
+        finally:
+            part.checkpoint(True)
+        done[0] += rest[0]
+    
+    part.finish(hash)
+    print('\t\tSaved to %s!' % part.fPath)
+    return part.fPath
+
+def fetch_ranges(url, outPath, ranges, fName, stop=None, offset=0, done=None, hash=None, checkpoint=None):
+    # Fetches each (start, end) byte range of url on its own connection and writes it at offset+start in outPath.
+    # done[n] tracks how many bytes of ranges[n] made it to disk, so callers can resume after a failure.
+    # hash, if given, is fed the data as it arrives, which only makes sense for a single range.
+    # checkpoint, if given, is called every time data reaches the disk.
+    if done is None:
+        done = [0] * len(ranges)
+    
+    failed = threading.Event()
+    task = track(fName, sum(end-start+1 for start, end in ranges))
+    
+    def fetch(n, start, end):
+        def wrote(count):
+            done[n] += count
+            if checkpoint is not None:
+                checkpoint()
+            
+        def progress(count):
+            if failed.is_set(): # Another range failed
+                raise InterruptedError('Download of %s aborted!' % fName)
+            task.update(count)
+        
+        # Throttling, server errors and dropped connections are retried from the first byte not on disk yet,
+        # on another host when one is healthy
+        attempt = 0
+        while True:
+            r = None
+            try:
+                with connection_slot():
+                    first = start + done[n]
+                    r = make_request('GET', url, hdArgs={'Range': 'bytes=%s-%s' % (first, end), 'Accept-Encoding': 'identity'})
+                    observe_response(r)
+                    if r.status_code != 206:
+                        r.close()
+                        error = 'Range %s-%s of %s failed, server returned %s!' % (first, end, fName, r.status_code)
+                        if r.status_code == 429 or r.status_code >= 500:
+                            raise requests.exceptions.HTTPError(error, response=r)
+                        raise ValueError(error)
+                    
+                    with open(outPath, 'r+b') as f:
+                        f.seek(offset + first)
+                        began = time.perf_counter()
+                        try:
+                            stream_body(r, f, end-first+1, fName, stop, hash, wrote, progress)
+                        finally:
+                            r.close()
+                            record('transfer', time.perf_counter() - began, start + done[n] - first, file=fName, range='%s-%s' % (first, end))
+                    
+                    if done[n] != end-start+1:
+                        raise requests.exceptions.ConnectionError('Range %s-%s of %s ended early (%s/%s)!'
+                                                                  % (start, end, fName, done[n], end-start+1))
+                return
+            except requests.exceptions.RequestException as e:
+                if r is not None and r.status_code == 206:
+                    host_failed(r, type(e).__name__)
+                attempt += 1
+                if attempt > config['Download']['Retries'] or failed.is_set():
+                    raise
+                print('\t\t%s, retrying (%s/%s)...' % (str(e).rstrip('!'), attempt, config['Download']['Retries']))
+                record('retry', 0, file=fName, reason=type(e).__name__)
+                if not host_available(url):
+                    backoff(attempt, stop)
+    
+    if len(ranges) == 1:
+        try:
+            fetch(0, *ranges[0])
+        finally:
+            untrack(task)
         return
     
-    t = ''
+    pool = ThreadPoolExecutor(max_workers=len(ranges))
+    futures = [pool.submit(contextvars.copy_context().run, fetch, n, start, end) for n, (start, end) in enumerate(ranges)]
+    try:
+        for future in as_completed(futures):
+            future.result()
+    except BaseException:
+        failed.set()
+        raise
+    finally:
+        pool.shutdown(wait=True)
+        untrack(task)
 
-    for reg_list in list([reg, 'US', 'EU', 'AU', 'KR', 'TW', 'JP']):
-        url = 'https://bugyo.hac.%s.eshop.nintendo.net/shogun/v1/contents/ids?shop_id=4&lang=en&country=%s&type=title&title_ids=%s'\
-            % (env, reg_list, baseTid)
-        r = make_request('GET', url, certificate=ShopNPath)
-        if r.status_code == 200:
-            t = r
-        if r.status_code == 404:
+def split_range(start, end, segments):
+    step = -(-(end-start+1) // segments)
+    return [(n, min(n+step, end+1)-1) for n in range(start, end+1, step)]
+
+def run_jobs(jobs, workers=1):
+    # jobs are callables taking a stop event, run in order by at most workers threads.
+    # If one of them fails, the others are told to stop and the error is raised.
+    stop = threading.Event()
+    if workers <= 1 or len(jobs) <= 1:
+        return [job(stop) for job in jobs]
+    
+    def worker(job):
+        if stop.is_set():
+            raise InterruptedError('Job aborted!')
+        return job(stop)
+    
+    pool = ThreadPoolExecutor(max_workers=workers)
+    # The executor hands out jobs in submission order, so priority is kept
+    futures = [pool.submit(contextvars.copy_context().run, worker, job) for job in jobs]
+    try:
+        for future in as_completed(futures):
+            future.result()
+    except BaseException:
+        stop.set()
+        for future in futures:
+            future.cancel()
+        print('\nA download failed, aborting the remaining %s downloads...' % sum(not f.done() for f in futures))
+        raise
+    finally:
+        pool.shutdown(wait=True)
+    
+    return [future.result() for future in futures]
+
+def nca_job(desc, url, fPath, expHash, segments=1, segmentSize=0x4000000):
+    def run(stop):
+        print('\tDownloading %s...' % desc)
+        download_file(url, fPath, stop=stop, segments=segments, segmentSize=segmentSize, expHash=expHash)
+        store_add(fPath, os.path.basename(fPath)[:-4])
+        return fPath
+    return run
+
+def download_NCAs(jobs, workers=1, segments=1, segmentSize=0x4000000):
+    # jobs is a list of (description, url, fPath, expected hash) tuples, in the order they should be fetched
+    return run_jobs([nca_job(*args, segments=segments, segmentSize=segmentSize) for args in jobs], workers)
+
+def download_NSP(nspPath, files, sizes, urls, workers=1, segments=1, segmentSize=0x4000000, hashes={}):
+    # Streams every entry straight to its final offset in the NSP. files and sizes list the entries in
+    # order, urls maps the entries that still have to be downloaded to their CDN URL and hashes to their
+    # expected SHA-256.
+    NSP = nsp(nspPath, files)
+    hd = NSP.gen_header(len(files), files, sizes)
+    offsets = []
+    total = len(hd)
+    for size in sizes:
+        offsets.append(total)
+        total += size
+    
+    journalPath = nspPath + '.journal'
+    journal = {}
+    if os.path.exists(journalPath):
+        with open(journalPath, 'r') as f:
+            journal = json.load(f)
+        if journal.get('header') != sha256(hd).hexdigest() or not os.path.exists(nspPath) or os.path.getsize(nspPath) != total:
+            print('\tExisting %s does not match this title, restarting...' % os.path.basename(nspPath))
+            journal = {}
+        else:
+            print('\tResuming %s...' % os.path.basename(nspPath))
+            record('retry', 0, file=os.path.basename(nspPath), reason='resume')
+    elif os.path.exists(nspPath) and os.path.getsize(nspPath) == total:
+        with open(nspPath, 'rb') as f:
+            if f.read(len(hd)) == hd:
+                print('\t%s is already complete, skipping!' % os.path.basename(nspPath))
+                return nspPath
+    
+    lock = threading.Lock()
+    def save_journal():
+        with open(journalPath + '.tmp', 'w') as f:
+            json.dump(journal, f)
+        os.replace(journalPath + '.tmp', journalPath)
+    
+    saved = [time.monotonic()]
+    def checkpoint(name, ranges, done, force=False):
+        # Called whenever data of an entry reached the NSP, the journal is rewritten at most once every part_file.interval
+        with lock:
+            if not force and time.monotonic() - saved[0] < part_file.interval:
+                return
+            saved[0] = time.monotonic()
+            remaining[name] = [[start+dlded, end] for (start, end), dlded in zip(ranges, done) if start+dlded <= end]
+            save_journal()
+    
+    if journal == {}:
+        # Remaining byte ranges of every entry, relative to the start of that entry
+        journal = {'header': sha256(hd).hexdigest(),
+                   'remaining': {os.path.basename(file): [[0, size-1]] if size else [] for file, size in zip(files, sizes)}}
+        save_journal()
+        with open(nspPath, 'wb') as f:
+            f.write(hd)
+            f.truncate(total)
+            preallocate(f, 0, total)
+    
+    remaining = journal['remaining']
+    for file, offset in zip(files, offsets):
+        name = os.path.basename(file)
+        if file not in urls and remaining[name]: # Cert, tik, cnmt.nca and cnmt.xml are already on disk
+            with open(nspPath, 'r+b') as outf:
+                copy_into(file, outf.fileno(), offset)
+            remaining[name] = []
+            save_journal()
+    
+    def job(file, offset, size):
+        name = os.path.basename(file)
+        def run(stop):
+            ranges = [tuple(rng) for rng in remaining[name]]
+            if ranges == []:
+                return
+            print('\tDownloading %s into %s...' % (name, os.path.basename(nspPath)))
+            if segments > 1 and len(ranges) == 1 and ranges[0][1]-ranges[0][0]+1 >= 2*segmentSize:
+                left = ranges[0][1]-ranges[0][0]+1
+                ranges = split_range(ranges[0][0], ranges[0][1], min(segments, left//segmentSize))
+            done = [0] * len(ranges)
+            # A fresh single-stream entry can be hashed on the fly, anything else is hashed from the NSP afterwards
+            hash = sha256() if ranges == [(0, size-1)] else None
+            try:
+                fetch_ranges(urls[file], nspPath, ranges, name, stop, offset, done, hash,
+                             checkpoint=lambda: checkpoint(name, ranges, done))
+            finally:
+                checkpoint(name, ranges, done, True)
+            
+            expHash = hashes.get(file, '')
+            if expHash != '':
+                if hash is None:
+                    hash = hash_range(nspPath, offset, size)
+                if hash.hexdigest() != expHash:
+                    with lock:
+                        remaining[name] = [[0, size-1]]
+                        save_journal()
+                    raise ValueError('%s is corrupted, its SHA-256 (%s) does not match the CNMT (%s)!'
+                                     % (name, hash.hexdigest(), expHash))
+        return run
+    
+    run_jobs([job(file, offset, size) for file, offset, size in zip(files, offsets, sizes) if file in urls], workers)
+    
+    os.remove(journalPath)
+    print('\tRepacked to %s!' % nspPath)
+    return nspPath
+
+def decrypt_NCA(fPath, outDir='', sections=None):
+    fName = os.path.basename(fPath).split()[0]
+    
+    if outDir == '':
+        outDir = os.path.splitext(fPath)[0]
+    os.makedirs(outDir, exist_ok=True)
+    if sections is None:
+        sections = ncaSections
+    
+    hactool = hactoolPath if os.path.isabs(hactoolPath) else os.path.join('.', hactoolPath)
+    commandLine = [hactool, fPath]
+    if keysPath != '':
+        commandLine += ['-k', keysPath]
+    for section in sections: # Sections that aren't asked for aren't written at all
+        if section == 'header':
+            commandLine.append('--header=%s' % os.path.join(outDir, 'Header.bin'))
+        else:
+            commandLine.append('--%sdir=%s' % (section, os.path.join(outDir, section)))
+                  
+    start = time.perf_counter()
+    try:            
+        subprocess.check_output(commandLine, stderr=subprocess.STDOUT)
+        if os.listdir(outDir) == []:
+            raise subprocess.CalledProcessError(0, commandLine, ('Output folder %s is empty!' % outDir).encode())
+    except subprocess.CalledProcessError:
+        print('\nDecryption of %s failed!' % fName)
+        raise
+    record('decrypt', time.perf_counter() - start, os.path.getsize(fPath), file=fName, tool='hactool')
+        
+    return outDir
+
+def read_manifest(outDir):
+    try:
+        with open(os.path.join(outDir, '.manifest.json'), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_manifest(fPath, outDir, sections):
+    st = os.stat(fPath)
+    files = {}
+    for root, dirs, names in os.walk(outDir):
+        for name in names:
+            if name != '.manifest.json':
+                path = os.path.join(root, name)
+                files[os.path.relpath(path, outDir)] = os.path.getsize(path)
+    manifest = {'nca': os.path.basename(fPath), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                'sections': sorted(sections), 'files': files}
+    with open(os.path.join(outDir, '.manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+def is_extracted(fPath, outDir, sections):
+    # The output is only trusted if it was made from this exact NCA, with these sections, and is still all there
+    manifest = read_manifest(outDir)
+    if manifest is None:
+        return False
+    st = os.stat(fPath)
+    if (manifest.get('size'), manifest.get('mtime_ns'), manifest.get('sections')) != (st.st_size, st.st_mtime_ns, sorted(sections)):
+        return False
+    for path, size in manifest['files'].items():
+        try:
+            if os.path.getsize(os.path.join(outDir, path)) != size:
+                return False
+        except OSError:
+            return False
+    return True
+
+def extract_NCAs(paths, sections=None, workers=None):
+    # Runs hactool over every NCA in paths (files or folders), one process per core at a time
+    if sections is None:
+        sections = ncaSections
+    if workers is None:
+        workers = os.cpu_count() or 1
+    
+    NCAs = find_files(paths, '.nca')
+    
+    def extract(fPath):
+        outDir = os.path.splitext(fPath)[0]
+        if is_extracted(fPath, outDir, sections):
+            return 'skipped'
+        if os.path.isdir(outDir):
+            shutil.rmtree(outDir) # Leftovers from another NCA version or section list
+        decrypt_NCA(fPath, outDir, sections)
+        write_manifest(fPath, outDir, sections)
+        return 'extracted'
+    
+    print('Extracting %s NCAs with %s workers...' % (len(NCAs), workers))
+    results = {'extracted': 0, 'skipped': 0, 'failed': 0}
+    # hactool does the work in its own processes, threads only wait on them
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(extract, fPath): fPath for fPath in NCAs}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except (subprocess.CalledProcessError, OSError) as e:
+                result = 'failed'
+                print('\t%s: %s' % (os.path.basename(futures[future]), e))
+            results[result] += 1
+            if result != 'failed':
+                print('\t%s: %s' % (os.path.basename(futures[future]), result))
+    
+    print('%s extracted, %s already up to date, %s failed' % (results['extracted'], results['skipped'], results['failed']))
+    return results
+
+def find_files(paths, ext):
+    # Files in paths, folders are searched for files ending with ext
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                found.extend(os.path.join(root, name) for name in sorted(names) if name.endswith(ext))
+        else:
+            found.append(path)
+    return found
+
+def hash_view(view, hash=None):
+    if hash is None:
+        hash = sha256()
+    for n in range(0, len(view), 0x1000000): # hashlib releases the GIL, so entries hash on all cores at once
+        hash.update(view[n:n+0x1000000])
+    return hash
+
+def list_NSPs(paths):
+    failed = 0
+    for fPath in find_files(paths, '.nsp'):
+        try:
+            NSP = nsp_reader(fPath)
+        except (OSError, ValueError) as e:
+            failed += 1
+            print('\t%s' % e)
             continue
-        if len(r.json()['id_pairs']):
-            break
+        try:
+            try:
+                contents = NSP.contents()
+            except (ValueError, ET.ParseError) as e:
+                failed += 1
+                print('\t%s: unreadable cnmt.xml (%s)' % (os.path.basename(fPath), e))
+                continue
+            print('%s (%s entries):' % (fPath, len(NSP.entries)))
+            for name, (offset, size) in NSP.entries.items():
+                type = contents[name][0] if name in contents else ''
+                print('\t%-48s %-16s %12s  at 0x%x' % (name, type, bytes2human(size), offset))
+        finally:
+            NSP.close()
+    return failed
+
+def verify_NSPs(paths, workers=None):
+    # Checks every NCA of every NSP in paths against the SHA-256 and size in its cnmt.xml. Entries of all
+    # the NSPs share one pool, so a large NCA doesn't leave the other cores idle, and only a few NSPs are
+    # mapped at once.
+    if workers is None:
+        workers = os.cpu_count() or 1
+    NSPs = find_files(paths, '.nsp')
+    print('Verifying %s NSPs with %s workers...' % (len(NSPs), workers))
+    
+    results = {'ok': 0, 'corrupted': 0, 'failed': 0}
+    lock = threading.Lock()
+    opened = threading.BoundedSemaphore(workers*2)
+    
+    def report(fPath, problems, checked):
+        with lock:
+            if problems == []:
+                results['ok'] += 1
+                print('\t%s: ok (%s NCAs)' % (os.path.basename(fPath), checked))
+            else:
+                results['corrupted'] += 1
+                print('\t%s: %s' % (os.path.basename(fPath), ', '.join(problems)))
+    
+    def check(NSP, name, expSize, expHash, state):
+        try:
+            with NSP.entry(name) as view:
+                if expSize is not None and len(view) != expSize:
+                    problem = '%s is %s bytes instead of %s' % (name, len(view), expSize)
+                else:
+                    digest = hash_view(view).hexdigest()
+                    problem = '%s is corrupted' % name if digest[:len(expHash)] != expHash else None
+            NSP.drop_cache(name)
+        except BaseException as e:
+            problem = '%s could not be read (%s)' % (name, e)
+        with lock:
+            if problem is not None:
+                state['problems'].append(problem)
+            state['left'] -= 1
+            last = state['left'] == 0
+        if last:
+            NSP.close()
+            opened.release()
+            report(NSP.path, state['problems'], state['checked'])
+    
+    start = time.perf_counter()
+    nbytes = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for fPath in NSPs:
+            opened.acquire()
+            try:
+                NSP = nsp_reader(fPath)
+            except (OSError, ValueError) as e:
+                opened.release()
+                results['failed'] += 1
+                print('\t%s' % e)
+                continue
+            try:
+                contents = NSP.contents()
+                expected = NSP.expected(contents)
+            except (ValueError, ET.ParseError) as e:
+                contents = {}
+                expected = {}
+                problems = ['unreadable cnmt.xml (%s)' % e]
+            else:
+                problems = ['%s is missing' % name for name in contents if name not in NSP.entries]
+            if expected == {}:
+                NSP.close()
+                opened.release()
+                report(fPath, problems or ['no NCAs to verify'], 0)
+                continue
+            state = {'problems': problems, 'left': len(expected), 'checked': len(expected)}
+            for name, (expSize, expHash) in expected.items():
+                nbytes += NSP.entries[name][1]
+                pool.submit(check, NSP, name, expSize, expHash, state)
+    
+    seconds = time.perf_counter() - start
+    record('verify', seconds, nbytes)
+    print('%s ok, %s corrupted, %s unreadable (%s in %.1fs, %.1f MB/s)' % (results['ok'], results['corrupted'], results['failed'],
+          bytes2human(nbytes), seconds, nbytes / seconds / 1e6 if seconds else 0))
+    return results['corrupted'] + results['failed']
+
+def unpack_NSPs(paths, workers=None):
+    # Writes every entry of each NSP into a folder of the same name next to it, straight from the mapping.
+    # NCAs are checked against cnmt.xml from the same pass, so nothing is read twice.
+    if workers is None:
+        workers = os.cpu_count() or 1
+    failed = 0
+    for fPath in find_files(paths, '.nsp'):
+        outDir = os.path.splitext(fPath)[0]
+        try:
+            NSP = nsp_reader(fPath)
+        except (OSError, ValueError) as e:
+            failed += 1
+            print('\t%s' % e)
+            continue
+        try:
+            try:
+                expected = NSP.expected()
+            except (ValueError, ET.ParseError) as e:
+                failed += 1
+                print('\t%s: unreadable cnmt.xml (%s)' % (os.path.basename(fPath), e))
+                continue
+            os.makedirs(outDir, exist_ok=True)
+            print('Unpacking %s to %s...' % (os.path.basename(fPath), outDir))
+            
+            def unpack(name):
+                outName = os.path.basename(name)
+                if outName in ('', '.', '..'):
+                    raise ValueError('%s has an invalid entry name (%s)!' % (os.path.basename(fPath), name))
+                outPath = os.path.join(outDir, outName)
+                hash = sha256() if name in expected else None
+                with NSP.entry(name) as view, open(outPath, 'wb') as outf:
+                    preallocate(outf, 0, len(view))
+                    for n in range(0, len(view), 0x800000):
+                        with view[n:n+0x800000] as chunk:
+                            if hash is not None:
+                                hash.update(chunk)
+                            outf.write(chunk)
+                if hash is not None:
+                    expSize, expHash = expected[name]
+                    if hash.hexdigest()[:len(expHash)] != expHash or (expSize is not None and expSize != NSP.entries[name][1]):
+                        os.remove(outPath)
+                        raise ValueError('%s is corrupted, its SHA-256 (%s) does not match the CNMT (%s)!' % (name, hash.hexdigest(), expHash))
+                    store_hash(outPath, hash.hexdigest())
+                return outPath
             
-    if r.status_code == 404:
-        if t:
-            r = t
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(unpack, name): name for name in NSP.entries}
+                for future in as_completed(futures):
+                    try:
+                        print('\t%s' % os.path.basename(future.result()))
+                    except (OSError, ValueError) as e:
+                        failed += 1
+                        print('\t%s' % e)
+        finally:
+            NSP.close()
+    return failed
+
+def get_keys():
+    # keys.txt is only read once per run
+    global ncaKeys
+    with ncaKeysLock:
+        if ncaKeys is None:
+            ncaKeys = load_keys(keysPath if keysPath != '' else os.path.expanduser('~/.switch/prod.keys'))
+        return ncaKeys
+
+def load_keys(fPath):
+    # Reads a hactool keys file (name = hex value) and derives the NCA keys it doesn't list directly
+    keys = {}
+    with open(fPath, 'r') as f:
+        for line in f:
+            name, sep, value = line.partition('=')
+            try:
+                if sep:
+                    keys[name.strip().lower()] = uhx(value.strip())
+            except ValueError: # binascii.Error
+                pass
+    
+    kekSource = keys.get('aes_kek_generation_source')
+    keySource = keys.get('aes_key_generation_source')
+    if kekSource is None or keySource is None:
+        return keys
+    
+    if 'header_key' not in keys and 'master_key_00' in keys and 'header_kek_source' in keys and 'header_key_source' in keys:
+        headerKek = generate_kek(keys['header_kek_source'], keys['master_key_00'], kekSource, keySource)
+        keys['header_key'] = aes_ecb_decrypt(headerKek, keys['header_key_source'])
+    for rev in range(0x20):
+        if 'master_key_%02x' % rev not in keys:
+            continue
+        for kind in ['application', 'ocean', 'system']:
+            name = 'key_area_key_%s_%02x' % (kind, rev)
+            if name not in keys and 'key_area_key_%s_source' % kind in keys:
+                keys[name] = generate_kek(keys['key_area_key_%s_source' % kind], keys['master_key_%02x' % rev], kekSource, keySource)
+    
+    return keys
+
+def generate_kek(src, masterKey, kekSeed, keySeed):
+    kek = aes_ecb_decrypt(masterKey, kekSeed)
+    srcKek = aes_ecb_decrypt(kek, src)
+    return aes_ecb_decrypt(srcKek, keySeed)
+
+def aes_ecb_decrypt(key, data):
+    d = Cipher(algorithms.AES(key), modes.ECB()).decryptor()
+    return d.update(data) + d.finalize()
+
+def aes_ctr(key, iv, data):
+    d = Cipher(algorithms.AES(key), modes.CTR(iv)).decryptor()
+    return d.update(data) + d.finalize()
+
+def aes_xts_decrypt(key, data, sector, sectorSize=0x200):
+    # Nintendo uses the sector number as a big-endian tweak
+    out = []
+    for n in range(0, len(data), sectorSize):
+        d = Cipher(algorithms.AES(key), modes.XTS((sector + n//sectorSize).to_bytes(16, 'big'))).decryptor()
+        out.append(d.update(data[n:n+sectorSize]) + d.finalize())
+    return b''.join(out)
+
+def read_pfs0(data):
+    if data[:4] != b'PFS0':
+        raise ValueError('Not a PFS0 partition!')
+    filesNb, tableSize = upk('<II', data[0x4:0xC])
+    tableOffset = 0x10 + filesNb*0x18
+    dataOffset = tableOffset + tableSize
+    
+    files = {}
+    for n in range(filesNb):
+        offset, size, nameOffset = upk('<QQI', data[0x10+n*0x18:0x24+n*0x18])
+        nameEnd = data.find(b'\x00', tableOffset+nameOffset, dataOffset)
+        name = data[tableOffset+nameOffset:nameEnd if nameEnd != -1 else dataOffset].decode()
+        files[name] = data[dataOffset+offset:dataOffset+offset+size]
+    return files
+
+class nca:
+    # Header and section decryption for small NCAs such as cnmt.nca, sections are read whole into memory
+    def __init__(self, fPath, keys):
+        if Cipher is None:
+            raise ImportError('the cryptography library is not installed')
+        self.path = fPath
+        
+        with open(fPath, 'rb') as f:
+            enc = f.read(0xC00)
+        if len(enc) != 0xC00:
+            raise ValueError('%s is too small to be an NCA!' % os.path.basename(fPath))
+        
+        hd = aes_xts_decrypt(keys['header_key'], enc[:0x400], 0)
+        if hd[0x200:0x204] == b'NCA3':
+            hd = aes_xts_decrypt(keys['header_key'], enc, 0)
+        elif hd[0x200:0x204] == b'NCA2': # Section headers are each encrypted as sector 0
+            hd += b''.join(aes_xts_decrypt(keys['header_key'], enc[n:n+0x200], 0) for n in range(0x400, 0xC00, 0x200))
         else:
-            print('File not found on server: 404')
-            sys.exit()
+            raise ValueError('%s has an unknown header magic, is header_key right?' % os.path.basename(fPath))
+        self.header = hd
+        
+        self.cryptoType  = hd[0x206]
+        self.kaekInd     = hd[0x207]
+        self.cryptoType2 = hd[0x220] # What hactool's Header.bin gets read at 0x220 for
+        if hd[0x230:0x240] != bytes(0x10):
+            raise ValueError('%s uses titlekey crypto!' % os.path.basename(fPath))
+        
+        keyGen = max(self.cryptoType, self.cryptoType2)
+        if keyGen > 0:
+            keyGen -= 1
+        kaek = keys['key_area_key_%s_%02x' % (['application', 'ocean', 'system'][self.kaekInd], keyGen)]
+        self.keyArea = aes_ecb_decrypt(kaek, hd[0x300:0x340])
+        
+    def section(self, n):
+        start, end = upk('<II', self.header[0x240+n*0x10:0x248+n*0x10])
+        start *= 0x200
+        end *= 0x200
+        fsHd = self.header[0x400+n*0x200:0x600+n*0x200]
+        
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            data = f.read(end-start)
+        
+        if fsHd[0x4] == 1: # No encryption
+            return data
+        elif fsHd[0x4] == 3: # AES-CTR
+            iv = fsHd[0x140:0x148][::-1] + pk('>Q', start >> 4)
+            return aes_ctr(self.keyArea[0x20:0x30], iv, data)
+        raise ValueError('Section %s of %s uses unsupported crypto type %s!' % (n, os.path.basename(self.path), fsHd[0x4]))
+        
+    def pfs0(self, n):
+        fsHd = self.header[0x400+n*0x200:0x600+n*0x200]
+        if fsHd[0x3] != 2:
+            raise ValueError('Section %s of %s is not a PFS0!' % (n, os.path.basename(self.path)))
+        offset, size = upk('<QQ', fsHd[0x40:0x50])
+        return read_pfs0(self.section(n)[offset:offset+size])
 
-    j = r.json()
+def read_cnmt(ncaPath):
+    # Decrypts the CNMT in memory, hactool is only used when that isn't possible
+    try:
+        start = time.perf_counter()
+        NCA = nca(ncaPath, get_keys())
+        name, data = [(name, data) for name, data in NCA.pfs0(0).items() if name.endswith('.cnmt')][0]
+        CNMT = cnmt(os.path.join(os.path.dirname(ncaPath), name), data)
+        CNMT.mKeyRev = str(NCA.cryptoType2)
+        record('decrypt', time.perf_counter() - start, os.path.getsize(ncaPath), file=os.path.basename(ncaPath), tool='cryptography')
+        return CNMT
+    except (ImportError, OSError, KeyError, ValueError, IndexError) as e:
+        print('\t\tCan\'t decrypt %s in-process (%s), using hactool...' % (os.path.basename(ncaPath), repr(e)))
+    
+    cnmtDir = decrypt_NCA(ncaPath)
+    CNMT = cnmt(os.path.join(cnmtDir, 'section0', os.listdir(os.path.join(cnmtDir, 'section0'))[0]))
+    with open(os.path.join(cnmtDir, 'Header.bin'), 'rb') as ncaHd:
+        CNMT.mKeyRev = str(read_u8(ncaHd, 0x220))
+    return CNMT
+    
+def copy_into(fPath, fdOut, offset, reflink=False):
+    # Copies a whole file to offset in fdOut, letting the kernel move the data whenever it can
+    size = os.path.getsize(fPath)
+    copied = 0
+    with open(fPath, 'rb') as inf:
+        fdIn = inf.fileno()
+        
+        if reflink and fcntl is not None and offset % 0x1000 == 0:
+            try: # FICLONERANGE with a length of 0 clones up to the end of the source
+                fcntl.ioctl(fdOut, FICLONERANGE, pk('<qQQQ', fdIn, 0, 0, offset))
+                return size
+            except OSError:
+                pass # Not supported by this filesystem, or source and destination are on different ones
+        
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while copied < size:
+                    n = os.copy_file_range(fdIn, fdOut, size-copied, copied, offset+copied)
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError:
+                pass
+        
+        if copied < size and sys.platform.startswith('linux') and hasattr(os, 'sendfile'): # Other platforms only sendfile to sockets
+            try:
+                os.lseek(fdOut, offset+copied, os.SEEK_SET)
+                while copied < size:
+                    n = os.sendfile(fdOut, fdIn, copied, size-copied)
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError:
+                pass
         
+        if copied < size:
+            inf.seek(copied)
+            os.lseek(fdOut, offset+copied, os.SEEK_SET)
+            buf = bytearray(0x800000)
+            view = memoryview(buf)
+            while copied < size:
+                n = inf.readinto(buf)
+                if n == 0:
+                    break
+                written = 0
+                while written < n:
+                    written += os.write(fdOut, view[written:n])
+                copied += n
+    
+    if copied != size:
+        raise ValueError('Copied data is not as big as expected (%s/%s)!' % (copied, size))
+    return size
+
+def store_dir():
+    dir = config['Store']['Path']
+    if not os.path.isabs(dir):
+        dir = os.path.join(os.path.dirname(__file__), dir)
+    return dir
+
+def store_path(ncaID):
+    # NCA IDs are content hashes, so the store is laid out by ID: store/ab/ab....nca
+    return os.path.join(store_dir(), ncaID[:2], '%s.nca' % ncaID)
+
+def link_file(src, dst):
+    # Hardlinks src to dst, or clones/copies it when hardlinks aren't possible (other filesystem, FAT...)
     try:
-        nsuid = j['id_pairs'][0]['id']
-        url = 'https://bugyo.hac.%s.eshop.nintendo.net/shogun/v1/titles/%s?shop_id=4&lang=en&country=%s' % (env, nsuid, reg_list)
-        r = make_request('GET', url, certificate=ShopNPath)
-        j = r.json()
-        name = j['formal_name']
+        os.link(src, dst)
+        return
+    except FileExistsError:
+        raise
+    except OSError:
+        pass
+    with open(dst + '.tmp', 'wb') as f:
+        copy_into(src, f.fileno(), 0, reflink=True)
+    os.replace(dst + '.tmp', dst)
 
-        title_name = re.sub(r'[/\\:*?"|™©®]+', "", name)
-        
+def store_fetch(ncaID, fPath):
+    # Puts the stored copy of ncaID at fPath, returns False if it isn't in the store
+    if config['Store']['Enabled'] == False or not os.path.exists(store_path(ncaID)):
+        return False
+    if os.path.exists(fPath):
+        if os.path.samefile(fPath, store_path(ncaID)):
+            return True
+        os.remove(fPath) # Partial or stale copy, the stored one has been verified already
+    link_file(store_path(ncaID), fPath)
+    store_ref(ncaID, fPath)
+    return True
+
+def store_add(fPath, ncaID):
+    # Only called on verified files
+    if config['Store']['Enabled'] == False:
+        return
+    if not os.path.exists(store_path(ncaID)):
+        os.makedirs(os.path.dirname(store_path(ncaID)), exist_ok=True)
         try:
-            size = j['total_rom_size']
-        except KeyError:
+            link_file(fPath, store_path(ncaID))
+        except FileExistsError: # Another title stored it first
             pass
-        
-        print('\tName: %s' % name)
-        try:
-            print('\tSize: %s' % bytes2human(size))
-        except NameError:
-            print('\t\tNo size was found for %s' % tid)
-        print('\tBase TID:   %s' % baseTid)
-        print('\tUpdate TID: %s' % updateTid)
-    except IndexError:
-        print('\tCan\'t get name of title, TitleID not found on Shogun!')
-        title_name = 'Unknown'
-    
-    url = 'https://tagaya.hac.%s.eshop.nintendo.net/tagaya/hac_versionlist' % env
-    r = make_request('GET', url)
-    j = r.json()
+    store_ref(ncaID, fPath)
 
-    n = 0
-    for game in j['titles']:
-        n += 1
-        if updateTid in game['id']:
-            lastestVer = game['version']
-            print('\tAvailable update versions for %s:' % updateTid)
-            print('\t\tv%s' % " v".join(str(i) for i in range(0x10000, lastestVer+1, 0x10000)))
-            break
-    
-    if n == len(j['titles']):
-        print('\t%s has no update available!' % updateTid)
+def refs_path(ncaID):
+    return os.path.join(store_dir(), 'refs', ncaID[:2], ncaID)
 
-def download_file(url, fPath):
-    fName = os.path.basename(fPath).split()[0]
+def store_refs(ncaID):
+    # Paths recorded as using the stored ncaID that still exist
+    try:
+        with open(refs_path(ncaID), 'r') as f:
+            paths = f.read().splitlines()
+    except OSError:
+        return []
+    return [path for path in OrderedDict.fromkeys(paths) if path and os.path.exists(path)]
 
-    if os.path.exists(fPath):
-        dlded = os.path.getsize(fPath)
-        r = make_request('GET', url, hdArgs={'Range': 'bytes=%s-' % dlded})
-        
-        if r.headers.get('Server') != 'openresty/1.9.7.4':
-            print('\t\tDownload is already complete, skipping!')
-            return fPath
-        elif r.headers.get('Content-Range') == None: # CDN doesn't return a range if request >= filesize
-            fSize = int(r.headers.get('Content-Length'))
-        else:
-            fSize = dlded + int(r.headers.get('Content-Length'))
-            
-        if dlded == fSize:
-            print('\t\tDownload is already complete, skipping!')
-            return fPath
-        elif dlded < fSize:
-            print('\t\tResuming download...')
-            f = open(fPath, 'ab')
-        else:
-            print('\t\tExisting file is bigger than expected (%s/%s), restarting download...' % (dlded, fSize))
-            dlded = 0
-            f = open(fPath, "wb")
-    else:
-        dlded = 0
-        r = make_request('GET', url)
-        fSize = int(r.headers.get('Content-Length'))
-        f = open(fPath, 'wb')
-        
-    chunkSize = 1000
-    if tqdmProgBar == True and fSize >= 10000:
-        for chunk in tqdm(r.iter_content(chunk_size=chunkSize), initial=dlded//chunkSize, total=fSize//chunkSize,
-                          desc=fName, unit='kb', smoothing=1, leave=False):
-            f.write(chunk)
-            dlded += len(chunk)
-    elif fSize >= 10000:
-        for chunk in r.iter_content(chunkSize): # https://stackoverflow.com/questions/15644964/python-progress-bar-and-downloads
-            f.write(chunk)
-            dlded += len(chunk)
-            done = int(50 * dlded / fSize)
-            sys.stdout.write('\r%s:  [%s%s] %d/%d b' % (fName, '=' * done, ' ' * (50-done), dlded, fSize) )    
-            sys.stdout.flush()
-        sys.stdout.write('\033[F')
-    else:
-        f.write(r.content)
-        dlded += len(r.content)
-    
-    if fSize != 0 and dlded != fSize:
-        raise ValueError('Downloaded data is not as big as expected (%s/%s)!' % (dlded, fSize))
-        
-    f.close()    
-    print('\r\t\tSaved to %s!' % f.name)
-    return fPath
+def store_ref(ncaID, fPath):
+    # Records that fPath (a title folder's NCA, or an NSP the stored NCA was packed into) uses ncaID.
+    # Copies and reflinks don't show in the link count, so this is what gc_store goes by.
+    if config['Store']['Enabled'] == False:
+        return
+    fPath = os.path.abspath(fPath)
+    with storeRefsLock:
+        try:
+            with open(refs_path(ncaID), 'r') as f:
+                if fPath in f.read().splitlines():
+                    return
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(refs_path(ncaID)), exist_ok=True)
+        with open(refs_path(ncaID), 'a') as f:
+            f.write(fPath + '\n')
 
-def decrypt_NCA(fPath, outDir=''):
-    fName = os.path.basename(fPath).split()[0]
+def stored_title(tid, ver):
+    # CNMT ID of a title version that went through the store before, saving the HEAD request
+    if config['Store']['Enabled'] == False:
+        return None
+    try:
+        with open(os.path.join(store_dir(), 'titles', '%s-%s' % (tid, ver)), 'r') as f:
+            CNMTid = f.read().strip()
+    except OSError:
+        return None
+    return CNMTid if os.path.exists(store_path(CNMTid)) else None
+
+def store_title(tid, ver, CNMTid):
+    if config['Store']['Enabled'] == False:
+        return
+    os.makedirs(os.path.join(store_dir(), 'titles'), exist_ok=True)
+    fPath = os.path.join(store_dir(), 'titles', '%s-%s' % (tid, ver))
+    with open(fPath + '.tmp', 'w') as f:
+        f.write(CNMTid)
+    os.replace(fPath + '.tmp', fPath)
+
+def gc_store():
+    # Removes the stored NCAs nothing uses anymore: no title folder hardlinks them and no title folder
+    # or NSP recorded with store_ref still exists. Entries stored before uses were recorded that had to be
+    # copied rather than hardlinked (store on another filesystem, FAT...) can't be told apart from unused ones.
+    dir = store_dir()
+    if not os.path.isdir(dir):
+        print('Store %s is empty.' % dir)
+        return 0
     
-    if outDir == '':
-        outDir = os.path.splitext(fPath)[0]
-    os.makedirs(outDir, exist_ok=True)
+    freed = 0
+    removed = 0
+    for root, dirs, files in os.walk(dir):
+        if root == dir:
+            dirs[:] = [name for name in dirs if name not in ['titles', 'refs']]
+        for file in files:
+            fPath = os.path.join(root, file)
+            st = os.stat(fPath)
+            if file.endswith('.tmp'):
+                os.remove(fPath)
+            elif file.endswith('.nca'):
+                ncaID = file[:-4]
+                users = store_refs(ncaID)
+                if st.st_nlink > 1 or users:
+                    with open(refs_path(ncaID) + '.tmp', 'w') as f: # Users that are gone are dropped
+                        f.write(''.join(user + '\n' for user in users))
+                    os.replace(refs_path(ncaID) + '.tmp', refs_path(ncaID))
+                    continue
+                os.remove(fPath)
+                if os.path.exists(refs_path(ncaID)):
+                    os.remove(refs_path(ncaID))
+            else:
+                continue
+            freed += st.st_size
+            removed += 1
+        if root != dir and os.listdir(root) == []:
+            os.rmdir(root)
     
-    commandLine = './' + hactoolPath + ' "' + fPath + '"' + keysArg\
-                  + ' --exefsdir="'    + os.path.join(outDir, 'exefs') + '"'\
-                  + ' --romfsdir="'    + os.path.join(outDir, 'romfs') + '"'\
-                  + ' --section0dir="' + os.path.join(outDir, 'section0') + '"'\
-                  + ' --section1dir="' + os.path.join(outDir, 'section1') + '"'\
-                  + ' --section2dir="' + os.path.join(outDir, 'section2') + '"'\
-                  + ' --section3dir="' + os.path.join(outDir, 'section3') + '"'\
-                  + ' --header="'      + os.path.join(outDir, 'Header.bin') + '"'
-                  
-    try:            
-        subprocess.check_output(commandLine, shell=True)
-        if os.listdir(outDir) == []:
-            raise subprocess.CalledProcessError('\nDecryption failed, output folder %s is empty!' % outDir)
-    except subprocess.CalledProcessError:
-        print('\nDecryption failed!')
-        raise
-        
-    return outDir
+    titlesDir = os.path.join(dir, 'titles')
+    if os.path.isdir(titlesDir):
+        for file in os.listdir(titlesDir):
+            fPath = os.path.join(titlesDir, file)
+            with open(fPath, 'r') as f:
+                CNMTid = f.read().strip()
+            if not os.path.exists(store_path(CNMTid)):
+                os.remove(fPath)
     
+    print('Removed %s unreferenced NCAs from %s, freeing %s.' % (removed, dir, bytes2human(freed)))
+    return freed
+
 def download_cetk(rightsID, fPath):
     url = 'https://atum.hac.%s.d4c.nintendo.net/r/t/%s?device_id=%s' % (env, rightsID, did)
     r = make_request('HEAD', url)
@@ -283,30 +2361,61 @@ def download_cetk(rightsID, fPath):
     
     return cetk
         
-def download_title(gameDir, tid, ver, tkey='', nspRepack=False, n=''):
+def get_cnmt(gameDir, tid, ver, n=''):
+    # Fetches (or takes from the store) and decrypts the CNMT of a title version
+    CNMTid = stored_title(tid, ver)
+    if CNMTid is None:
+        url = 'https://atum%s.hac.%s.d4c.nintendo.net/t/a/%s/%s?device_id=%s' % (n, env, tid, ver, did)
+        r = make_request('HEAD', url)
+        CNMTid = r.headers.get('X-Nintendo-Content-ID')
+        if CNMTid == None:
+            raise FileNotFoundError('CNMT of %s v%s not found on server!' % (tid, ver))
+    fPath = os.path.join(gameDir, CNMTid + '.cnmt.nca')
+    if store_fetch(CNMTid, fPath):
+        print('\tCNMT (%s.cnmt.nca) found in the store!' % CNMTid)
+        cnmtNCA = fPath
+    else:
+        print('\tDownloading CNMT (%s.cnmt.nca)...' % CNMTid)
+        url = 'https://atum%s.hac.%s.d4c.nintendo.net/c/a/%s?device_id=%s' % (n, env, CNMTid, did)
+        cnmtNCA = download_file(url, fPath, expHash=CNMTid) # Content IDs are the first half of the NCA's SHA-256
+        store_add(cnmtNCA, CNMTid)
+    store_title(tid, ver, CNMTid)
+    return cnmtNCA, read_cnmt(cnmtNCA)
+
+def nca_jobs(CNMT, gameDir, n='', direct=False):
+    # Download jobs for the NCAs of a CNMT that aren't already available locally, along with
+    # the path of every NCA by type and their sizes
+    jobs = []
+    NCAs = {}
+    ncaSizes = {}
+    for type in [0, 3, 4, 5, 1, 2, 6]: # Download smaller files first
+        entries = CNMT.parse(CNMT.ncaTypes[type])
+        for ncaID in entries:
+            url = 'https://atum%s.hac.%s.d4c.nintendo.net/c/c/%s?device_id=%s' % (n, env, ncaID, did)
+            fPath = os.path.join(gameDir, ncaID + '.nca')
+            if direct and config['Store']['Enabled'] and os.path.exists(store_path(ncaID)):
+                fPath = store_path(ncaID) # Copied into the NSP from the store, nothing to download
+            elif direct or not store_fetch(ncaID, fPath):
+                jobs.append(('%s entry (%s.nca)' % (CNMT.ncaTypes[type], ncaID), url, fPath, entries[ncaID][2]))
+            else:
+                print('\t%s entry (%s.nca) found in the store!' % (CNMT.ncaTypes[type], ncaID))
+            NCAs.setdefault(type, []).append(fPath)
+            ncaSizes[fPath] = int(entries[ncaID][1])
+    return jobs, NCAs, ncaSizes
+
+def download_title(gameDir, tid, ver, tkey='', nspRepack=False, n='', workers=1, segments=1, segmentSize=0x4000000, nspPath=''):
     print('\n%s v%s:' % (tid, ver))
     if len(tid) != 16:
         tid = (16-len(tid)) * '0' + tid
+    currentTitle.set(tid)
         
-    url = 'https://atum%s.hac.%s.d4c.nintendo.net/t/a/%s/%s?device_id=%s' % (n, env, tid, ver, did)
-    r = make_request('HEAD', url)
-    CNMTid = r.headers.get('X-Nintendo-Content-ID')
-    if CNMTid == None:
-        print('CNMT not found on server!')
-        sys.exit()
-    print('\tDownloading CNMT (%s.cnmt.nca)...' % CNMTid)
-    url = 'https://atum%s.hac.%s.d4c.nintendo.net/c/a/%s?device_id=%s' % (n, env, CNMTid, did)
-    fPath = os.path.join(gameDir, CNMTid + '.cnmt.nca')
-    cnmtNCA = download_file(url, fPath)
-    cnmtDir = decrypt_NCA(cnmtNCA)
-    CNMT = cnmt(os.path.join(cnmtDir, 'section0', os.listdir(os.path.join(cnmtDir, 'section0'))[0]))
+    cnmtNCA, CNMT = get_cnmt(gameDir, tid, ver, n)
     
     if nspRepack == True:
         outf = os.path.join(gameDir, '%s.xml' % os.path.basename(cnmtNCA.strip('.nca')))
         cnmtXML = CNMT.gen_xml(cnmtNCA, outf)
         
-        with open(os.path.join(cnmtDir, 'Header.bin'), 'rb') as ncaHd:
-            mKeyRev = str(read_u8(ncaHd, 0x220))
+        mKeyRev = CNMT.mKeyRev
         rightsID = '%s%s%s' % (tid, (16-len(mKeyRev))*'0', mKeyRev)
         
         
@@ -345,13 +2454,10 @@ def download_title(gameDir, tid, ver, tkey='', nspRepack=False, n=''):
                     
             print('\t\tExtracted %s and %s from cetk!' % (os.path.basename(certPath), os.path.basename(tikPath)))
         
-    NCAs = {}
-    for type in [0, 3, 4, 5, 1, 2, 6]: # Download smaller files first
-        for ncaID in CNMT.parse(CNMT.ncaTypes[type]):
-            print('\tDownloading %s entry (%s.nca)...' % (CNMT.ncaTypes[type], ncaID))
-            url = 'https://atum%s.hac.%s.d4c.nintendo.net/c/c/%s?device_id=%s' % (n, env, ncaID, did)
-            fPath = os.path.join(gameDir, ncaID + '.nca')
-            NCAs.update({type: download_file(url, fPath)})
+    jobs, NCAs, ncaSizes = nca_jobs(CNMT, gameDir, n, direct=nspPath != '')
+    
+    if nspPath == '':
+        download_NCAs(jobs, workers, segments, segmentSize)
     
     if nspRepack == True:
         files = []
@@ -359,20 +2465,33 @@ def download_title(gameDir, tid, ver, tkey='', nspRepack=False, n=''):
         if tkey != '':
             files.append(tikPath)
         for key in [1, 5, 2, 4, 6]:
-            try:
-                files.append(NCAs[key])
-            except KeyError:
-                pass
+            files.extend(NCAs.get(key, []))
         files.append(cnmtNCA)
         files.append(cnmtXML)
-        try:
-            files.append(NCAs[3])
-        except KeyError:
-            pass
+        files.extend(NCAs.get(3, []))
+        
+        if nspPath != '':
+            # The CNMT gives every NCA size up front, so the NCAs can go straight into the NSP
+            sizes = [ncaSizes[file] if file in ncaSizes else os.path.getsize(file) for file in files]
+            urls = {fPath: url for desc, url, fPath, expHash in jobs}
+            hashes = {fPath: expHash for desc, url, fPath, expHash in jobs}
+            download_NSP(nspPath, files, sizes, urls, workers, segments, segmentSize, hashes)
+            for file in files: # The NSP holds its own copy of the stored NCAs, title folder or not
+                ncaID = os.path.basename(file).split('.')[0]
+                if file.endswith('.nca') and os.path.exists(store_path(ncaID)):
+                    store_ref(ncaID, nspPath)
         
         return files
     
-def download_game(tid, ver, tkey='', nspRepack=False):
+def download_game(tid, ver, tkey='', nspRepack=False, workers=1, segments=1, segmentSize=0x4000000, direct=False, reflink=False, name=''):
+    if tid.endswith('800') and str(ver) == '0': # Latest update
+        ver = latest_version(tid)
+        if ver is None:
+            print('\t%s has no update available!' % tid)
+            return
+        ver = str(ver)
+    currentTitle.set(tid)
+    
     if tid.endswith('000'):   # Base game
         gameDir = os.path.join(os.path.dirname(__file__), tid)
     elif tid.endswith('800'): # Update
@@ -386,49 +2505,40 @@ def download_game(tid, ver, tkey='', nspRepack=False):
         return
     os.makedirs(gameDir, exist_ok=True)
     
-    if tid.endswith('800') and ver == 0:
-        url = 'https://tagaya.hac.%s.eshop.nintendo.net/tagaya/hac_versionlist' % env
-        r = make_request('GET', url)
-        j = r.json()
-    
-        n = 0
-        for game in j['titles']:
-            n += 1
-            if updateTid in game['id']:
-                ver = game['version']
-                break
-    
-        if n == len(j['titles']):
-            raise ValueError('\t%s has no update available!' % updateTid)
-    
+    if not tid.endswith('00'):
+        ttype = 'DLC'
+    elif tid.endswith('000'):
+        ttype = 'GAME'
+    elif tid.endswith('800'):
+        ttype = 'UPDATE'
+    else:
+        ttype = 'UNKWN'
+
+    name = re.sub(r'[/\\:*?"|™©®]+', "", name or 'Unknown')
+    outf = os.path.join(gameDir, '%.34s [%s][%s].nsp' % (name, ttype, tid))
     
-    files = download_title(gameDir, tid, ver, tkey, nspRepack)
+    files = download_title(gameDir, tid, ver, tkey, nspRepack, workers=workers, segments=segments, segmentSize=segmentSize,
+                           nspPath=outf if nspRepack and direct else '')
     
-    if nspRepack == True:
+    if nspRepack == True and direct == False:
         print('Creating NSP. Please wait...')
-
-        if not tid.endswith('00'):
-            ttype = 'DLC'
-        elif tid.endswith('000'):
-            ttype = 'GAME'
-        elif tid.endswith('800'):
-            ttype = 'UPDATE'
-        else:
-            ttype = 'UNKWN'
-
-        outf = os.path.join(gameDir, '%.34s [%s][%s].nsp' % (title_name, ttype, tid))
         NSP = nsp(outf, files)
-        NSP.repack()
+        NSP.repack(reflink)
     
     return gameDir
     
-def download_sysupdate(ver):
+def latest_sysupdate(ttl=None):
+    if ttl is None:
+        ttl = config['Cache']['SysUpdateTTL']
+    url = 'https://sun.hac.%s.d4c.nintendo.net/v1/system_update_meta?device_id=%s' % (env, did)
+    r = cached_request(url, ttl=ttl)
+    return str(r.json()['system_update_metas'][0]['title_version'])
+
+def download_sysupdate(ver, workers=1, segments=1, segmentSize=0x4000000, packTypes=None):
     if ver == '0':
-        url = 'https://sun.hac.%s.d4c.nintendo.net/v1/system_update_meta?device_id=%s' % (env, did)
-        r = make_request('GET', url)
-        j = r.json()
-        ver = str(j['system_update_metas'][0]['title_version'])
+        ver = latest_sysupdate()
     
+    currentTitle.set('0100000000000816') # System titles are accounted to the update as a whole
     sysupdateDir = os.path.join(os.path.dirname(__file__), '0100000000000816', ver)
     os.makedirs(sysupdateDir, exist_ok=True)
     
@@ -436,85 +2546,309 @@ def download_sysupdate(ver):
     r = make_request('HEAD', url)
     
     cnmtID = r.headers.get('X-Nintendo-Content-ID')
+    if cnmtID is None:
+        raise FileNotFoundError('System update %s not found on server!' % ver)
     print('\nDownloading CNMT (%s)...' % cnmtID)
     url = 'https://atumn.hac.%s.d4c.nintendo.net/c/s/%s?device_id=%s' % (env, cnmtID, did)
     fPath = os.path.join(sysupdateDir, '%s.cnmt.nca' % cnmtID)
-    cnmtNCA = download_file(url, fPath)
-    dir = decrypt_NCA(cnmtNCA)
-    CNMT = cnmt(os.path.join(dir, 'section0', os.listdir(os.path.join(dir, 'section0'))[0]))
+    cnmtNCA = download_file(url, fPath, expHash=cnmtID)
+    CNMT = read_cnmt(cnmtNCA)
     
     titles = CNMT.parse()
-    for title in titles:
+    if packTypes is not None:
+        titles = {title: titles[title] for title in titles if titles[title][1] in packTypes}
+    print('\nResolving %s system titles...' % len(titles))
+    
+    def resolve(title):
         dir = os.path.join(sysupdateDir, title)
         os.makedirs(dir, exist_ok=True)
-        download_title(dir, title, titles[title][0], n='n')
-        
+        cnmtNCA, titleCNMT = get_cnmt(dir, title, titles[title][0], n='n')
+        return nca_jobs(titleCNMT, dir, n='n')[0]
+    
+    # The small title CNMTs are all fetched and decrypted at once, and the NCAs of each title go into
+    # one shared download queue as soon as its CNMT is parsed
+    stop = threading.Event()
+    resolver = ThreadPoolExecutor(max_workers=max(1, min(len(titles), config['Network']['PoolMaxSize'])))
+    downloader = ThreadPoolExecutor(max_workers=workers)
+    resolving = [resolver.submit(contextvars.copy_context().run, resolve, title) for title in titles]
+    downloads = []
+    try:
+        for future in as_completed(resolving):
+            for job in future.result():
+                downloads.append(downloader.submit(contextvars.copy_context().run, nca_job(*job, segments=segments, segmentSize=segmentSize), stop))
+        for future in as_completed(downloads):
+            future.result()
+    except BaseException:
+        stop.set()
+        for future in resolving + downloads:
+            future.cancel()
+        print('\nA download failed, aborting the system update...')
+        raise
+    finally:
+        resolver.shutdown(wait=True)
+        downloader.shutdown(wait=True)
+    
+    print('\nDownloaded %s NCAs for %s system titles.' % (len(downloads), len(titles)))
     return sysupdateDir
     
+def read_jobs(fPath):
+    # One JSON object per line: {"tid": ..., "version": 0, "titlekey": "", "repack": true, "priority": 0}
+    # Only tid is required. Higher priorities run first, equal ones in file order.
+    jobs = []
+    with open(fPath, 'r') as f:
+        for lineNb, line in enumerate(f, 1):
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            try:
+                j = json.loads(line)
+                tid = j['tid'].lower()
+                tkey = (j.get('titlekey') or '').lower()
+                int(tid, 16)
+                priority = int(j.get('priority', 0))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                raise ValueError('Line %s of %s is not a valid job!' % (lineNb, fPath))
+            if len(tid) != 16:
+                raise ValueError('TitleID %s is not a 16-digits hexadecimal number!' % tid)
+            if tkey != '' and len(tkey) != 32:
+                raise ValueError('Titlekey %s is not a 32-digits hexadecimal number!' % tkey)
+            jobs.append({'line': lineNb, 'tid': tid, 'version': str(j.get('version', 0)), 'titlekey': tkey,
+                         'repack': j.get('repack'), 'priority': priority})
+    
+    jobs.sort(key=lambda job: -job['priority'])
+    return jobs
+
+def run_batch(jobPath, resultsPath='', titles=1, nspRepack=False, workers=1, segments=1, segmentSize=0x4000000, direct=False, reflink=False):
+    # Runs every job of a job file with at most titles titles downloading at once and
+    # appends one result record per job to resultsPath
+    jobs = read_jobs(jobPath)
+    if resultsPath == '':
+        resultsPath = os.path.splitext(jobPath)[0] + '.results.jsonl'
+    
+    # Jobs an earlier run completed are skipped, so a batch restarted after a crash picks up where it stopped
+    lines = []
+    if os.path.exists(resultsPath):
+        with open(resultsPath, 'r') as f:
+            lines = f.read().split('\n')
+    finished = set()
+    for line in lines:
+        try:
+            result = json.loads(line)
+        except ValueError: # Empty, or cut short by a crash
+            continue
+        if result.get('status') == 'ok' and os.path.exists(result.get('path') or ''):
+            finished.add((result['tid'], result['version']))
+    skipped = len(jobs)
+    jobs = [job for job in jobs if (job['tid'], job['version']) not in finished]
+    skipped -= len(jobs)
+    if skipped:
+        print('Skipping %s jobs already completed according to %s.' % (skipped, resultsPath))
+    print('Running %s jobs from %s, %s at a time...' % (len(jobs), jobPath, titles))
+    
+    results = open(resultsPath, 'a')
+    if lines[-1:] not in ([], ['']): # Don't append to a line a crash left unfinished
+        results.write('\n')
+    try:
+        done = run_titles(jobs, results, titles, nspRepack, workers, segments, segmentSize, direct, reflink)
+    finally:
+        results.close()
+    
+    completed = sum(result['status'] == 'ok' for result in done)
+    failed = sum(result['status'] == 'failed' for result in done)
+    print('\n%s of %s jobs completed, %s failed, %s without an update. Results written to %s'
+          % (completed, len(done), failed, len(done)-completed-failed, resultsPath))
+    return failed
+
+def run_titles(jobs, results, titles=1, nspRepack=False, workers=1, segments=1, segmentSize=0x4000000, direct=False, reflink=False, finished=None):
+    # Downloads jobs with at most titles titles at once, writes one result record per job to the results
+    # file and hands it to finished, both under the same lock. Returns the results in job order.
+    lock = threading.Lock()
+    
+    # Metadata of the upcoming jobs is looked up while the current ones are downloading
+    prefetch = ThreadPoolExecutor(max_workers=2)
+    infos = [prefetch.submit(lookup_title, job['tid']) for job in jobs]
+    
+    def run(n):
+        job = jobs[n]
+        repack = job['repack'] if job['repack'] is not None else nspRepack
+        result = {'line': job['line'], 'tid': job['tid'], 'version': job['version'], 'priority': job['priority']}
+        start = time.time()
+        try:
+            try:
+                info = infos[n].result()
+                name = info['name'] if info['name'] is not None else 'Unknown'
+            except Exception as e: # The title can still be downloaded without its name
+                print('\n%s: name lookup failed (%s)' % (job['tid'], str(e) or type(e).__name__))
+                name = 'Unknown'
+            result['name'] = name
+            print('\n%s: %s' % (job['tid'], name))
+            if job['tid'].endswith('800') and str(job['version']) == '0' and latest_version(job['tid']) is None:
+                result['status'] = 'no update'
+                result['error'] = '%s has no update available!' % job['tid']
+            else:
+                result['path'] = download_game(job['tid'], job['version'], job['titlekey'], repack, workers, segments, segmentSize,
+                                               direct and repack, reflink, name)
+                result['status'] = 'ok' if result['path'] is not None else 'failed'
+                if result['path'] is None:
+                    result['error'] = 'Invalid shogun TitleID %s!' % job['tid']
+        except (Exception, SystemExit) as e: # One bad job doesn't stop the others
+            result['status'] = 'failed'
+            result['error'] = str(e) or type(e).__name__
+            print('\n%s failed: %s' % (job['tid'], result['error']))
+        result['elapsed'] = round(time.time() - start, 3)
+        
+        with lock:
+            results.write(json.dumps(result) + '\n')
+            results.flush()
+            if finished is not None:
+                finished(result)
+        return result
+    
+    pool = ThreadPoolExecutor(max_workers=titles)
+    try:
+        return list(pool.map(lambda n: contextvars.copy_context().run(run, n), range(len(jobs))))
+    finally:
+        pool.shutdown(wait=True)
+        for future in infos:
+            future.cancel()
+        prefetch.shutdown(wait=True)
+
+def run_mirror(listPath, statePath='', resultsPath='', titles=1, nspRepack=False, workers=1, segments=1, segmentSize=0x4000000,
+               direct=False, reflink=False, packTypes=None):
+    # Downloads the latest update of every game in listPath, and the latest system update if 0100000000000816
+    # is listed, unless it was already mirrored. The versions mirrored are saved to statePath as each one
+    # completes, so a run only downloads what changed since the last one.
+    tids = read_tids(listPath)
+    for tid in tids:
+        if len(tid) != 16 or re.match('^[0-9a-f]+$', tid) is None:
+            raise ValueError('TitleID %s is not a 16-digits hexadecimal number!' % tid)
+    if statePath == '':
+        statePath = os.path.splitext(listPath)[0] + '.mirror.json'
+    if resultsPath == '':
+        resultsPath = os.path.splitext(listPath)[0] + '.results.jsonl'
+    
+    state = {'sysupdate': None, 'updates': {}}
+    if os.path.exists(statePath):
+        with open(statePath, 'r') as f:
+            state.update(json.load(f))
+    def save():
+        with open(statePath + '.tmp', 'w') as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+        os.replace(statePath + '.tmp', statePath)
+    
+    failed = 0
+    if '0100000000000816' in tids:
+        tids.remove('0100000000000816')
+        ver = latest_sysupdate(ttl=0)
+        if ver != state['sysupdate']:
+            print('\nMirroring system update %s...' % ver)
+            try:
+                download_sysupdate(ver, workers, segments, segmentSize, packTypes)
+                state['sysupdate'] = ver
+                save()
+            except (Exception, SystemExit) as e:
+                failed += 1
+                print('\nSystem update %s failed: %s' % (ver, str(e) or type(e).__name__))
+        else:
+            print('System update %s is already mirrored.' % ver)
+    
+    # The versionlist is revalidated, and only updates whose version differs from the mirrored one are queued
+    versions = get_versionlist(ttl=0)
+    updateTids = list(OrderedDict.fromkeys(title_ids(tid)[1] for tid in tids))
+    jobs = []
+    for updateTid in updateTids:
+        ver = versions.get(updateTid)
+        if ver is not None and str(ver) != state['updates'].get(updateTid):
+            jobs.append({'line': len(jobs) + 1, 'tid': updateTid, 'version': str(ver), 'titlekey': '', 'repack': None, 'priority': 0})
+    print('%s of %s updates changed since the last run.' % (len(jobs), len(updateTids)))
+    
+    def finished(result):
+        if result['status'] == 'ok':
+            state['updates'][result['tid']] = result['version']
+            save()
+    
+    with open(resultsPath, 'a') as results:
+        done = run_titles(jobs, results, titles, nspRepack, workers, segments, segmentSize, direct, reflink, finished)
+    updatesFailed = sum(result['status'] != 'ok' for result in done)
+    print('\nMirrored %s updates, %s failed. State saved to %s' % (len(done) - updatesFailed, updatesFailed, statePath))
+    return failed + updatesFailed
+
+class content:
+    # One content record of a CNMT
+    __slots__ = ('id', 'type', 'size', 'hash')
+    
+    def __init__(self, id, type, size, hash):
+        self.id = id
+        self.type = type
+        self.size = size
+        self.hash = hash
+
 class cnmt:
-    def __init__(self, fPath):
-        self.packTypes = {0x1: 'SystemProgram',
-                          0x2: 'SystemData',
-                          0x3: 'SystemUpdate',
-                          0x4: 'BootImagePackage',
-                          0x5: 'BootImagePackageSafe',
-                          0x80:'Application',
-                          0x81:'Patch',
-                          0x82:'AddOnContent',
-                          0x83:'Delta'}
-                          
-        self.ncaTypes = {0:'Meta', 1:'Program', 2:'Data', 3:'Control', 
-                         4:'HtmlDocument', 5:'LegalInformation', 6:'DeltaFragment'}
-                    
-        f = open(fPath, 'rb')
+    packTypes = {0x1: 'SystemProgram',
+                 0x2: 'SystemData',
+                 0x3: 'SystemUpdate',
+                 0x4: 'BootImagePackage',
+                 0x5: 'BootImagePackageSafe',
+                 0x80:'Application',
+                 0x81:'Patch',
+                 0x82:'AddOnContent',
+                 0x83:'Delta'}
+                      
+    ncaTypes = {0:'Meta', 1:'Program', 2:'Data', 3:'Control', 
+                4:'HtmlDocument', 5:'LegalInformation', 6:'DeltaFragment'}
+
+    def __init__(self, fPath, data=None):
+        if data is None:
+            with open(fPath, 'rb') as f:
+                data = f.read()
         
         self.path = fPath
-        self.type = self.packTypes[read_u8(f, 0xC)]
-        self.id = '0%s' % format(read_u64(f, 0x0), 'x')
-        self.ver = str(read_u32(f, 0x8))
-        self.sysver = str(read_u64(f, 0x28))
-        self.dlsysver = str(read_u64(f, 0x18))
-        self.digest = hx(read_at(f, f.seek(0, 2)-0x20, f.seek(0, 2))).decode()
+        self.data = data       # Decrypted in memory by read_cnmt, otherwise read from fPath in one go
+        self.mKeyRev = None    # Key generation from the NCA header, set by read_cnmt
         
-        f.close()
-
-    def parse(self, ncaType=''):
-        f = open(self.path, 'rb')
+        tid, ver, type, tableOffset, contentEntriesNB, metaEntriesNB = upk_from('<QIB1xHHH', data, 0x0)
+        self.type = self.packTypes[type]
+        self.id = '0%s' % format(tid, 'x')
+        self.ver = str(ver)
+        self.sysver = str(upk_from('<Q', data, 0x28)[0]) if len(data) >= 0x30 else '0'
+        self.dlsysver = str(upk_from('<Q', data, 0x18)[0])
+        self.digest = hx(data[-0x20:]).decode()
         
-        data = {}
+        view = memoryview(data)
+        self.titles = {}       # SystemUpdate: TitleID -> (version, pack type)
+        self.contents = []
+        self.byType = {}       # Content type name -> {NCA ID: (type, size, hash)}, what parse() returns
         if self.type == 'SystemUpdate':
-            EntriesNB = read_u16(f, 0x12)
-            for n in range(0x20, 0x10*EntriesNB, 0x10):
-                tid  = hex(read_u64(f, n))[2:]
-                if len(tid) != 16:
-                    tid = '%s%s' % ((16-len(tid))*'0',  tid)
-                ver  = str(read_u32(f, n+0x8))
-                packType = self.packTypes[read_u8(f, n+0xC)]
-                
-                data[tid] = ver, packType
+            offset = 0x20 + tableOffset
+            for tid, ver, packType in iter_upk('<QIB3x', view[offset:offset+0x10*metaEntriesNB]):
+                self.titles['%016x' % tid] = str(ver), self.packTypes[packType]
         else:
-            tableOffset = read_u16(f,0xE)
-            contentEntriesNB = read_u16(f, 0x10)
-            cmetadata = {}
-            for n in range(contentEntriesNB):
-                offset = 0x20 + tableOffset + 0x38*n
-                hash = hx(read_at(f, offset, 0x20)).decode()
-                tid  = hx(read_at(f, offset+0x20, 0x10)).decode()
-                size = str(read_u48(f, offset+0x30))
-                type = self.ncaTypes[read_u16(f, offset+0x36)]
-                
-                if type == ncaType or ncaType == '':
-                    data[tid] = type, size, hash
-    
-        f.close()
-        return data
+            offset = 0x20 + tableOffset
+            for hash, ncaID, size, type in iter_upk('<32s16s6sBx', view[offset:offset+0x38*contentEntriesNB]):
+                entry = content(hx(ncaID).decode(), self.ncaTypes[type], int.from_bytes(size, 'little'), hx(hash).decode())
+                self.contents.append(entry)
+                self.byType.setdefault(entry.type, {})[entry.id] = entry.type, str(entry.size), entry.hash
+        self.allContents = {}
+        for entry in self.contents:
+            self.allContents[entry.id] = entry.type, str(entry.size), entry.hash
+
+    def parse(self, ncaType=''):
+        # Records are decoded once in __init__, this only looks them up
+        if self.type == 'SystemUpdate':
+            return dict(self.titles)
+        if ncaType == '':
+            return dict(self.allContents)
+        return dict(self.byType.get(ncaType, {}))
      
     def gen_xml(self, ncaPath, outf):
+        start = time.perf_counter()
         data = self.parse()
-        hdPath = os.path.join(os.path.dirname(ncaPath),
-                 '%s.cnmt' % os.path.basename(ncaPath).split('.')[0], 'Header.bin')
-        with open(hdPath, 'rb') as ncaHd:
-            mKeyRev = str(read_u8(ncaHd, 0x220))
+        mKeyRev = self.mKeyRev
+        if mKeyRev is None: # Decrypted by hactool outside of read_cnmt
+            hdPath = os.path.join(os.path.dirname(ncaPath),
+                     '%s.cnmt' % os.path.basename(ncaPath).split('.')[0], 'Header.bin')
+            with open(hdPath, 'rb') as ncaHd:
+                mKeyRev = str(read_u8(ncaHd, 0x220))
             
         ContentMeta = ET.Element('ContentMeta')
         
@@ -538,10 +2872,7 @@ class cnmt:
         ET.SubElement(cnmt, 'Type').text = 'Meta'
         ET.SubElement(cnmt, 'Id').text   = os.path.basename(ncaPath).split('.')[0]
         ET.SubElement(cnmt, 'Size').text = str(os.path.getsize(ncaPath))
-        hash = sha256()
-        with open(ncaPath, 'rb') as nca:
-            hash.update(nca.read()) # Buffer not needed
-        ET.SubElement(cnmt, 'Hash').text          = hash.hexdigest()
+        ET.SubElement(cnmt, 'Hash').text          = file_sha256(ncaPath) # Usually recorded during the download
         ET.SubElement(cnmt, 'KeyGeneration').text = mKeyRev
             
         ET.SubElement(ContentMeta, 'Digest').text                = self.digest
@@ -556,7 +2887,7 @@ class cnmt:
         reparsed = minidom.parseString(string)
         with open(outf, 'w') as f:
             f.write(reparsed.toprettyxml(encoding='utf-8', indent='  ').decode()[:-1])
-            
+        record('xml', time.perf_counter() - start, file=os.path.basename(outf))
             
         print('\t\tGenerated %s!' % os.path.basename(outf))
         return outf
@@ -566,51 +2897,436 @@ class nsp:
         self.path = outf
         self.files = files
         
-    def repack(self):
+    def repack(self, reflink=False):
         files = self.files
-        hd = self.gen_header(len(files), files)
+        # Reflinks need block-aligned destinations, so pad the header up to a block for the first entry
+        hd = self.gen_header(len(files), files, align=0x1000 if reflink else 0x10)
         
+        start = time.perf_counter()
         outf = open(self.path, 'wb')
         outf.write(hd)
+        outf.flush()
+        offset = len(hd)
         for f in files:
-            with open(f, 'rb') as inf:
-                while True:
-                    buf = inf.read(4096)
-                    if not buf:
-                        break
-                    outf.write(buf)
+            offset += copy_into(f, outf.fileno(), offset, reflink)
+        record('repack', time.perf_counter() - start, offset, file=os.path.basename(self.path))
     
         print('\tRepacked to ' + outf.name + '!')
         outf.close()
         
-    def gen_header(self, filesNb, files):
-        stringTable = '\x00'.join(os.path.basename(file) for file in files)
-        headerSize = 0x10 + (filesNb)*0x18 + len(stringTable)
-        remainder = 0x10 - headerSize%0x10
-        headerSize += remainder
+    def gen_header(self, filesNb, files, fileSizes=None, align=0x10):
+        names = [os.path.basename(file).encode() for file in files]
+        stringTable = b'\x00'.join(names)
+        tableOffset = 0x10 + filesNb*0x18
+        headerSize = tableOffset + len(stringTable)
+        remainder = align - headerSize%align
+        
+        if fileSizes is None:
+            fileSizes = [os.path.getsize(file) for file in files]
+        
+        header = bytearray(headerSize + remainder)
+        pk_into('<4sIII', header, 0, b'PFS0', filesNb, len(stringTable)+remainder, 0)
+        fileOffset = 0
+        nameOffset = 0
+        for n in range(filesNb):
+            pk_into('<QQI', header, 0x10 + n*0x18, fileOffset, fileSizes[n], nameOffset)
+            fileOffset += fileSizes[n]
+            nameOffset += len(names[n]) + 1 # +1 for the \x00
+        header[tableOffset:headerSize] = stringTable
         
-        fileSizes = [os.path.getsize(file) for file in files]
-        fileOffsets = [sum(fileSizes[:n]) for n in range(filesNb)]
+        return bytes(header)
+
+class nsp_reader:
+    # Memory-maps an NSP and parses the PFS0 header gen_header writes. Entries are slices of the
+    # mapping, so listing, hashing and extracting them never copies the data into Python objects.
+    def __init__(self, fPath):
+        self.path = fPath
+        self.f = open(fPath, 'rb')
+        try:
+            size = os.fstat(self.f.fileno()).st_size
+            if size < 0x10:
+                raise ValueError('%s is too small to be an NSP!' % os.path.basename(fPath))
+            self.map = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        except BaseException:
+            self.f.close()
+            raise
+        if hasattr(self.map, 'madvise'): # Entries are read front to back, let the kernel read ahead
+            self.map.madvise(mmap.MADV_SEQUENTIAL)
+        self.view = memoryview(self.map)
         
-        fileNamesLengths = [len(os.path.basename(file))+1 for file in files] # +1 for the \x00
-        stringTableOffsets = [sum(fileNamesLengths[:n]) for n in range(filesNb)]
+        if self.view[:4] != b'PFS0':
+            self.close()
+            raise ValueError('%s is not an NSP, it has no PFS0 header!' % os.path.basename(fPath))
+        filesNb, tableSize = upk_from('<II', self.view, 0x4)
+        tableOffset = 0x10 + filesNb*0x18
+        dataOffset = tableOffset + tableSize
+        if dataOffset > size:
+            self.close()
+            raise ValueError('%s is truncated, its header is cut short!' % os.path.basename(fPath))
         
-        header =  b''
-        header += b'PFS0'
-        header += pk('<I', filesNb)
-        header += pk('<I', len(stringTable)+remainder)
-        header += b'\x00\x00\x00\x00'
+        self.entries = OrderedDict() # Name -> (offset in the NSP, size)
         for n in range(filesNb):
-            header += pk('<Q', fileOffsets[n])
-            header += pk('<Q', fileSizes[n])
-            header += pk('<I', stringTableOffsets[n])
-            header += b'\x00\x00\x00\x00'
-        header += stringTable.encode()
-        header += remainder * b'\x00'
-        
-        return header
+            offset, fSize, nameOffset = upk_from('<QQI', self.view, 0x10 + n*0x18)
+            nameEnd = self.map.find(b'\x00', tableOffset+nameOffset, dataOffset)
+            name = bytes(self.view[tableOffset+nameOffset:nameEnd if nameEnd != -1 else dataOffset]).decode()
+            if dataOffset+offset+fSize > size:
+                self.close()
+                raise ValueError('%s is truncated, %s ends past the end of the file!' % (os.path.basename(fPath), name))
+            self.entries[name] = (dataOffset+offset, fSize)
+    
+    def entry(self, name):
+        offset, size = self.entries[name]
+        return self.view[offset:offset+size]
+    
+    def contents(self):
+        # Type, size and SHA-256 of every content listed in the cnmt.xml entries, keyed by entry name
+        contents = {}
+        for name in self.entries:
+            if not name.endswith('.cnmt.xml'):
+                continue
+            ContentMeta = ET.fromstring(bytes(self.entry(name)))
+            for Content in ContentMeta.iter('Content'):
+                type = Content.findtext('Type')
+                fName = '%s.cnmt.nca' % Content.findtext('Id') if type == 'Meta' else '%s.nca' % Content.findtext('Id')
+                contents[fName] = (type, int(Content.findtext('Size')), Content.findtext('Hash').lower())
+        return contents
+    
+    def expected(self, contents=None):
+        # Expected size and hash of every NCA: from cnmt.xml, else the content ID in its name, the first half of its SHA-256
+        if contents is None:
+            contents = self.contents()
+        expected = OrderedDict()
+        for name in self.entries:
+            if name in contents:
+                expected[name] = contents[name][1:]
+            elif name.endswith('.nca') and re.match('^[0-9a-f]{32}$', name.split('.')[0]):
+                expected[name] = (None, name.split('.')[0])
+        return expected
+    
+    def drop_cache(self, name):
+        # Scrubbing a library would otherwise push everything useful out of the page cache
+        if hasattr(os, 'posix_fadvise'):
+            offset, size = self.entries[name]
+            os.posix_fadvise(self.f.fileno(), offset, size, os.POSIX_FADV_DONTNEED)
+    
+    def close(self):
+        if hasattr(self, 'view'):
+            self.view.release()
+        self.map.close()
+        self.f.close()
+
+class client:
+    # A configured CDNSP: paths, console values, config, run-wide limits, stats and progress display, and
+    # the jobs it can run. The download functions read the settings through the module globals install()
+    # points at this client, so a process runs one client at a time and install() refuses to take them
+    # over while another client is open. Its sessions and caches stay warm for as long as it lives, which
+    # is what daemon mode keeps it around for.
+    def __init__(self, configPath=''):
+        if configPath == '':
+            configPath = os.path.join(os.path.dirname(__file__), 'CDNSPconfig.json')
+        (self.hactoolPath, self.keysPath, self.NXclientPath, self.ShopNPath,
+         self.reg, self.fw, self.did, self.env, self.config) = load_config(configPath)
+        self.connSlots = None
+        self.bandwidth = None
+        self.stats = None
+        self.reporter = None
+        self.catalog = None
+        download = self.config['Download']
+        self.options = {'nspRepack': False, 'workers': download['Workers'], 'segments': download['Segments'],
+                        'segmentSize': download['SegmentSize'] * 0x100000, 'direct': False, 'reflink': False}
+    
+    def configure(self, maxConnections=0, limit=0, metrics='', prometheus='', progress='none', catalog=False, adaptive=False):
+        self.open_catalog(catalog)
+        if adaptive: # Tuned between 1 and the ceiling, which is otherwise the size of a host's connection pool
+            self.connSlots = adaptive_limiter(maxConnections if maxConnections > 0 else self.config['Network']['PoolMaxSize'])
+        elif maxConnections > 0:
+            self.connSlots = threading.BoundedSemaphore(maxConnections)
+        if limit > 0:
+            self.bandwidth = rate_limiter(limit * 1024)
+        self.stats = run_stats(metrics, prometheus)
+        if progress == 'auto':
+            progress = 'bars' if sys.stdout.isatty() else 'json'
+        if progress != 'none':
+            self.reporter = progress_reporter(progress, self.config['Progress']['Interval'])
+        self.install()
+        if self.reporter is not None:
+            self.reporter.start()
+    
+    def open_catalog(self, create=False):
+        # The catalog is only used once --sync-catalog created it, and not at all without the metadata cache
+        fPath = self.config['Catalog']['Path']
+        if not os.path.isabs(fPath):
+            fPath = os.path.join(os.path.dirname(__file__), fPath)
+        if sqlite3 is not None and self.catalog is None and (create or self.config['Cache']['Enabled'] and os.path.exists(fPath)):
+            self.catalog = title_catalog(fPath)
+    
+    def install(self):
+        global hactoolPath, keysPath, NXclientPath, ShopNPath, reg, fw, did, env, config, connSlots, bandwidth, stats, reporter, titleCatalog, activeClient
+        if activeClient is not None and activeClient is not self:
+            raise ValueError('Another client is already active in this process, close it first!')
+        activeClient = self
+        hactoolPath, keysPath, NXclientPath, ShopNPath = self.hactoolPath, self.keysPath, self.NXclientPath, self.ShopNPath
+        reg, fw, did, env, config = self.reg, self.fw, self.did, self.env, self.config
+        connSlots, bandwidth, stats, reporter = self.connSlots, self.bandwidth, self.stats, self.reporter
+        titleCatalog = self.catalog
+    
+    def close(self):
+        global activeClient
+        if activeClient is self:
+            activeClient = None
+        if self.reporter is not None:
+            self.reporter.stop()
+        if self.stats is not None: # Also summarizes runs that failed halfway
+            self.stats.finish()
+        if self.catalog is not None:
+            self.catalog.close()
+    
+    def info(self, tid):
+        self.install()
+        return lookup_title(tid.lower())
+    
+    def download(self, tid, version='0', titlekey='', repack=None, direct=None, reflink=None, workers=None, segments=None, segmentSize=None):
+        self.install()
+        tid = tid.lower()
+        if len(tid) != 16 or re.match('^[0-9a-f]+$', tid) is None:
+            raise ValueError('TitleID %s is not a 16-digits hexadecimal number!' % tid)
+        options = self.job_options(workers=workers, segments=segments, segmentSize=segmentSize, nspRepack=repack, direct=direct, reflink=reflink)
+        if options['direct']:
+            options['nspRepack'] = True
+        try:
+            name = lookup_title(tid)['name'] or 'Unknown'
+        except Exception: # The title can still be downloaded without its name
+            name = 'Unknown'
+        return download_game(tid, str(version), titlekey.lower(), name=name, **options)
+    
+    def sysupdate(self, version='0', packTypes=None, workers=None, segments=None, segmentSize=None):
+        self.install()
+        options = self.job_options(workers=workers, segments=segments, segmentSize=segmentSize)
+        del options['nspRepack'], options['direct'], options['reflink']
+        return download_sysupdate(str(version), packTypes=packTypes, **options)
+    
+    def verify(self, paths, workers=None):
+        self.install()
+        return verify_NSPs(paths, workers)
+    
+    def job_options(self, **options):
+        # Download options of a job, the ones it leaves out (None) are those of the client
+        options = dict((key, value) for key, value in options.items() if value is not None)
+        if 'segmentSize' in options:
+            options['segmentSize'] *= 0x100000
+        return dict(self.options, **options)
+    
+    def job(self, params):
+        # Callable running a job posted as {"type": "game", "tid": ..., ...}, the other keys are the arguments of the method
+        params = dict(params)
+        kind = params.pop('type', None)
+        methods = {'info': self.info, 'game': self.download, 'sysupdate': self.sysupdate, 'verify': self.verify}
+        if kind not in methods:
+            raise ValueError('unknown job type %s, expected one of %s' % (kind, ', '.join(methods)))
+        try:
+            inspect.signature(methods[kind]).bind(**params)
+        except TypeError as e:
+            raise ValueError('%s job: %s' % (kind, e))
+        return lambda: methods[kind](**params)
+
+class daemon_job:
+    maxLog = 200 # Output lines kept per job
+    
+    def __init__(self, id, params):
+        self.id = id
+        self.params = params
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.future = None
+        self.log = deque(maxlen=self.maxLog)
+        self.partial = ''
+        self.lock = threading.Lock()
+    
+    def write(self, text):
+        with self.lock:
+            lines = (self.partial + text).split('\n')
+            self.partial = lines.pop()
+            self.log.extend(line for line in lines if line.strip())
+    
+    def state(self, log=False):
+        state = {'id': self.id, 'params': self.params, 'status': self.status, 'result': self.result, 'error': self.error,
+                 'created': self.created, 'started': self.started, 'finished': self.finished}
+        if log:
+            state['log'] = list(self.log)
+        return state
+
+class job_console:
+    # Stands in for sys.stdout in daemon mode, output of a job is also kept with the job
+    def __init__(self, out):
+        self.out = out
+    
+    def write(self, text):
+        job = currentJob.get()
+        if job is not None:
+            job.write(text)
+        return self.out.write(text)
+    
+    def __getattr__(self, name):
+        return getattr(self.out, name)
+
+class job_queue:
+    # Jobs of a daemon, run by a pool of titles workers with a warm client
+    maxFinished = 1000 # Finished jobs remembered for status requests
+    
+    def __init__(self, cdnsp, titles=1):
+        self.cdnsp = cdnsp
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        self.lastID = 0
+        self.pool = ThreadPoolExecutor(max_workers=titles)
+        self.started = time.time()
+    
+    def submit(self, params):
+        run = self.cdnsp.job(params) # Bad jobs are refused right away
+        with self.lock:
+            self.lastID += 1
+            job = daemon_job(self.lastID, params)
+            self.jobs[job.id] = job
+            finished = [id for id in self.jobs if self.jobs[id].finished is not None]
+            for id in finished[:max(0, len(finished) - self.maxFinished)]:
+                del self.jobs[id]
+            job.future = self.pool.submit(contextvars.copy_context().run, self.run, job, run)
+        return job
+    
+    def run(self, job, run):
+        currentJob.set(job)
+        job.status = 'running'
+        job.started = time.time()
+        try:
+            job.result = run()
+            job.status = 'done'
+        except (Exception, SystemExit) as e: # One bad job doesn't stop the daemon
+            job.status = 'failed'
+            job.error = str(e) or type(e).__name__
+            print('Job %s failed: %s' % (job.id, job.error))
+        job.finished = time.time()
+    
+    def cancel(self, id):
+        job = self.jobs[id]
+        if job.future.cancel():
+            job.status = 'cancelled'
+            job.finished = time.time()
+            return True
+        return False
+    
+    def status(self):
+        with self.lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+        hosts = {host: pool.status() for host, pool in list(hostPools.items()) if pool is not None}
+        return {'uptime': round(time.time() - self.started, 3), 'jobs': counts, 'sessions': len(sessions), 'hosts': hosts}
+    
+    def shutdown(self):
+        with self.lock:
+            for id in list(self.jobs):
+                if self.jobs[id].status == 'queued':
+                    self.cancel(id)
+        self.pool.shutdown(wait=False)
+
+class job_handler(BaseHTTPRequestHandler):
+    # POST /jobs, GET /jobs, GET /jobs/<id>, DELETE /jobs/<id> and GET /status, all JSON
+    def reply(self, code, body):
+        data = json.dumps(body, default=str).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def job_id(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] != 'jobs' or not parts[1].isdigit():
+            return None
+        return int(parts[1])
+    
+    def do_GET(self):
+        jobs = self.server.jobs
+        if self.path.rstrip('/') == '/status':
+            return self.reply(200, jobs.status())
+        if self.path.rstrip('/') == '/jobs':
+            with jobs.lock:
+                return self.reply(200, [job.state() for job in jobs.jobs.values()])
+        id = self.job_id()
+        if id is None or id not in jobs.jobs:
+            return self.reply(404, {'error': 'no such job'})
+        self.reply(200, jobs.jobs[id].state(log=True))
+    
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            return self.reply(404, {'error': 'jobs are posted to /jobs'})
+        try:
+            params = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if not isinstance(params, dict):
+                raise ValueError('a job is a JSON object')
+            job = self.server.jobs.submit(params)
+        except ValueError as e:
+            return self.reply(400, {'error': str(e)})
+        self.reply(202, job.state())
+    
+    def do_DELETE(self):
+        jobs = self.server.jobs
+        id = self.job_id()
+        if id is None or id not in jobs.jobs:
+            return self.reply(404, {'error': 'no such job'})
+        if not jobs.cancel(id):
+            return self.reply(409, {'error': 'job %s is already %s' % (id, jobs.jobs[id].status)})
+        self.reply(200, jobs.jobs[id].state())
+    
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'local'
+    
+    def log_message(self, format, *args):
+        pass # Jobs print their own progress
+
+class tcp_job_server(ThreadingHTTPServer):
+    daemon_threads = True
+
+class unix_job_server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def serve(cdnsp, address, titles=1):
+    # Runs jobs posted to address (HOST:PORT, or the path of a Unix socket) until interrupted
+    if re.match(r'^[^/\\]*:\d+$', address):
+        host, port = address.rsplit(':', 1)
+        server = tcp_job_server((host, int(port)), job_handler)
+        where = 'http://%s:%s' % server.server_address[:2]
+    else:
+        if not hasattr(socket, 'AF_UNIX'):
+            raise ValueError('Unix sockets are not supported here, listen on HOST:PORT instead!')
+        if os.path.exists(address): # Left behind by a daemon that didn't exit cleanly
+            os.remove(address)
+        server = unix_job_server(address, job_handler)
+        where = address
+    server.jobs = job_queue(cdnsp, titles)
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    if threading.current_thread() is threading.main_thread(): # Service managers stop daemons with SIGTERM
+        signal.signal(signal.SIGTERM, stop)
+    sys.stdout = job_console(sys.stdout)
+    print('Serving jobs on %s, %s at a time...' % (where, titles))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('\nStopping...')
+    finally:
+        server.server_close()
+        server.jobs.shutdown()
+        sys.stdout = sys.stdout.out
+        if server.address_family != socket.AF_INET and server.address_family != socket.AF_INET6:
+            os.remove(address)
+    return 0
   
-def main():
+def main(cdnsp):
     formatter = lambda prog: argparse.RawTextHelpFormatter(prog, max_help_position=40)
     parser = argparse.ArgumentParser(formatter_class=formatter)
     
@@ -619,6 +3335,22 @@ print info about a title:
    - name from shogun
    - available updates from versionlist''')
     
+    parser.add_argument('--info-file', dest='infoFile', default='', metavar='PATH', help='''\
+look up every TitleID listed in PATH like -i, one per line''')
+    
+    parser.add_argument('--info-out', dest='infoOut', default='', metavar='PATH', help='''\
+write what -i and --info-file find to PATH instead of printing it
+   - JSON array, or CSV if PATH ends with .csv
+   - TitleIDs that fail are recorded with their error, the others are still looked up''')
+    
+    parser.add_argument('--info-workers', dest='infoWorkers', type=int, default=config['Network']['PoolMaxSize'], metavar='N', help='''\
+number of TitleIDs looked up at once by -i, --info-file and --sync-catalog (default: %(default)s)''')
+    
+    parser.add_argument('--sync-catalog', dest='syncCatalog', action='store_true', default=False, help='''\
+build or update the local title catalog (default: Catalog/Path in the config file)
+   - the versionlist is diffed into it, shogun is only asked about games it has no name for
+   - title info and latest update versions are then answered from it, misses go to the CDN''')
+    
     parser.add_argument('-g', dest='games', default=[], metavar='TID-VER-TKEY', nargs='+', help='''\
 download games/updates/DLC's:
    - titlekey argument is optional
@@ -635,65 +3367,256 @@ download system updates:
            (= X*0x4000000 + Y*0x100000 + Z*0x10000 + B)
    - 0 will download the lastest update''')
    
+    parser.add_argument('--pack-types', dest='packTypes', default='', metavar='LIST', help='''\
+comma-separated pack types of the system titles downloaded by -s and --mirror (default: all)
+   - %s''' % ', '.join(cnmt.packTypes[type] for type in cnmt.packTypes if type < 0x80))
+    
     parser.add_argument('-r', dest='repack', action='store_true', default=False, help='''\
 repack the downloaded games to nsp format
    - for non-update titles, titlekey is required to generate tik
    - will generate/download cert, tik and cnmt.xml''')
+    
+    parser.add_argument('-d', dest='direct', action='store_true', default=False, help='''\
+download NCAs straight into the nsp instead of repacking afterwards (implies -r)
+   - halves disk I/O and space, no separate .nca files are kept
+   - interrupted downloads resume from the .nsp.journal file''')
+    
+    parser.add_argument('--reflink', dest='reflink', action='store_true', default=False, help='''\
+clone NCAs into the nsp instead of copying them when the filesystem supports it
+   - btrfs, XFS and similar; falls back to a regular kernel copy elsewhere''')
+    
+    parser.add_argument('-j', dest='workers', type=int, default=config['Download']['Workers'], metavar='N', help='''\
+number of NCAs to download concurrently
+   - smaller NCAs are still queued first
+   - if one download fails, the whole title is aborted''')
+    
+    parser.add_argument('-S', dest='segments', type=int, default=config['Download']['Segments'], metavar='N', help='''\
+split each large NCA into up to N byte ranges fetched in parallel''')
+    
+    parser.add_argument('--segment-size', dest='segmentSize', type=int, default=config['Download']['SegmentSize'], metavar='MB', help='''\
+smallest byte range a segmented download is split into (default: %(default)s)
+   - NCAs smaller than twice this size use a single stream''')
+                    
+    parser.add_argument('-b', dest='batch', default='', metavar='JOBFILE', help='''\
+download every title listed in a JSONL job file
+   - one {"tid": ..., "version": 0, "titlekey": "...", "repack": true, "priority": 0} per line
+   - only tid is required, repack defaults to -r, higher priorities run first
+   - metadata of upcoming jobs is prefetched while earlier ones download
+   - one result record per job (status ok, failed or no update) is appended to JOBFILE.results.jsonl
+   - jobs already recorded as ok there are skipped when the file is run again''')
+    
+    parser.add_argument('--mirror', dest='mirror', default='', metavar='LIST', help='''\
+download the latest update of every game in LIST that changed since the last run
+   - one TitleID per line, 0100000000000816 for the latest system update
+   - the versions mirrored are saved to --mirror-state, only newer ones are downloaded''')
+    
+    parser.add_argument('--mirror-state', dest='mirrorState', default='', metavar='PATH', help='''\
+file --mirror saves the versions it mirrored to (default: LIST with a .mirror.json extension)''')
+    
+    parser.add_argument('--results', dest='results', default='', metavar='PATH', help='''\
+file the -b and --mirror result records are appended to''')
+    
+    parser.add_argument('--titles', dest='titles', type=int, default=config['Batch']['Titles'], metavar='N', help='''\
+number of -b and --mirror jobs downloaded at once (default: %(default)s)''')
+    
+    parser.add_argument('--max-connections', dest='maxConnections', type=int, default=config['Download']['MaxConnections'], metavar='N', help='''\
+most downloads streaming at once across all titles, segments included (0: no limit)''')
+    
+    parser.add_argument('--adaptive', dest='adaptive', action='store_true', default=config['Download']['Adaptive'], help='''\
+tune the number of downloads streaming at once from measured throughput, TTFB and errors
+   - starts at 4, adds one while that raises throughput, halves on 429/5xx or dropped connections
+   - never above --max-connections (0: PoolMaxSize), -j and -S are the most it can use
+   - decisions are written to the --metrics log, decreases are also printed''')
+    
+    parser.add_argument('--limit', dest='limit', type=int, default=config['Download']['RateLimit'], metavar='KB/S', help='''\
+cap the combined download speed, in KB/s (0: no limit)''')
+    
+    parser.add_argument('--store', dest='store', action='store_true', default=config['Store']['Enabled'], help='''\
+keep every downloaded NCA in a store shared by all titles (default: Store/Enabled in the config file)
+   - NCAs already in the store are hardlinked into the title folder instead of downloaded
+   - falls back to reflinks or copies where hardlinks aren't possible''')
+    
+    parser.add_argument('--gc-store', dest='gcStore', action='store_true', default=False, help='''\
+remove the stored NCAs that no title folder or NSP uses anymore
+   - an NCA is in use while a title folder hardlinks it, or while a title folder or -d NSP it was
+     copied, reflinked or packed into still exists
+   - NCAs stored by older versions that had to be copied rather than hardlinked look unused''')
+    
+    parser.add_argument('--metrics', dest='metrics', default=config['Metrics']['Log'], metavar='PATH', help='''\
+append a JSON line per timed event (request, transfer, decryption, repack...) to PATH''')
+    
+    parser.add_argument('--prometheus', dest='prometheus', default=config['Metrics']['Textfile'], metavar='PATH', help='''\
+write per-title, per-phase totals to PATH in the Prometheus textfile format at the end of the run''')
+    
+    parser.add_argument('--progress', dest='progress', default=config['Progress']['Mode'], choices=['auto', 'bars', 'json', 'none'], help='''\
+how download progress is shown, redrawn every Progress/Interval seconds (default: %(default)s)
+   - bars: one line per download and a total, with rate and ETA
+   - json: one JSON line per redraw on stderr, for logs and wrappers
+   - auto: bars on a terminal, json otherwise''')
+    
+    parser.add_argument('-x', dest='extract', default=[], metavar='PATH', nargs='+', help='''\
+extract NCAs with hactool, in parallel
+   - PATH is an .nca file or a folder searched for .nca files
+   - each NCA is extracted next to itself, in a folder of the same name
+   - NCAs whose folder still matches its .manifest.json are skipped''')
+    
+    parser.add_argument('--sections', dest='sections', default=','.join(ncaSections), metavar='LIST', help='''\
+comma-separated sections to extract with -x (default: all)
+   - %s''' % ', '.join(ncaSections))
+    
+    parser.add_argument('--extract-workers', dest='extractWorkers', type=int, default=os.cpu_count() or 1, metavar='N', help='''\
+number of hactool processes run at once by -x (default: number of cores)''')
+                    
+    parser.add_argument('--list', dest='list', default=[], metavar='PATH', nargs='+', help='''\
+list the entries of NSPs with their type, size and offset
+   - PATH is an .nsp file or a folder searched for .nsp files''')
+    
+    parser.add_argument('--verify', dest='verify', default=[], metavar='PATH', nargs='+', help='''\
+check every NCA of NSPs against the SHA-256 and size in their cnmt.xml
+   - PATH is an .nsp file or a folder searched for .nsp files
+   - NSPs are memory-mapped and their NCAs hashed on all cores at once
+   - NCAs without a cnmt.xml entry are checked against the content ID in their name''')
+    
+    parser.add_argument('--unpack', dest='unpack', default=[], metavar='PATH', nargs='+', help='''\
+extract the entries of NSPs into a folder of the same name next to each
+   - NCAs are verified as they are written''')
+    
+    parser.add_argument('--nsp-workers', dest='nspWorkers', type=int, default=os.cpu_count() or 1, metavar='N', help='''\
+number of NSP entries hashed or unpacked at once by --verify and --unpack (default: number of cores)''')
+    
+    parser.add_argument('--daemon', dest='daemon', default=None, nargs='?', const=config['Daemon']['Listen'], metavar='ADDR', help='''\
+keep running and accept jobs over a local HTTP API instead (default ADDR: %s)
+   - ADDR is HOST:PORT or the path of a Unix socket
+   - connections, caches and keys stay warm between jobs; --titles jobs run at once
+   - POST /jobs {"type": "game", "tid": ..., "version": 0, "titlekey": ..., "repack": true}
+     (or "info", "sysupdate", "verify"), then GET /jobs/<id> for its status and output''' % config['Daemon']['Listen'])
+    
+    parser.add_argument('--no-cache', dest='noCache', action='store_true', default=False, help='''\
+don't use or update the metadata cache (versionlist, shogun, system update meta)''')
                     
     args = parser.parse_args()
+    if args.noCache:
+        config['Cache']['Enabled'] = False
+    if args.syncCatalog and sqlite3 is None:
+        parser.error('--sync-catalog needs Python\'s sqlite3 module')
+    config['Store']['Enabled'] = args.store
+    if args.workers < 1:
+        parser.error('-j must be at least 1')
+    if args.segments < 1 or args.segmentSize < 1:
+        parser.error('-S and --segment-size must be at least 1')
+    segOpts = {'segments': args.segments, 'segmentSize': args.segmentSize * 0x100000}
+    if args.titles < 1:
+        parser.error('--titles must be at least 1')
+    if args.direct:
+        args.repack = True
+    
+    packTypes = None
+    if args.packTypes != '':
+        names = {packType.lower(): packType for packType in cnmt.packTypes.values()}
+        packTypes = []
+        for packType in args.packTypes.split(','):
+            if packType.strip() == '':
+                continue
+            if packType.strip().lower() not in names:
+                parser.error('unknown pack type %s, expected some of %s' % (packType.strip(), ', '.join(cnmt.packTypes.values())))
+            packTypes.append(names[packType.strip().lower()])
     
-    if args.games == [] and args.sysupdates == [] and args.info == []:
+    if args.games == [] and args.sysupdates == [] and args.info == [] and args.infoFile == '' and not args.syncCatalog and args.extract == [] \
+       and args.batch == '' and args.mirror == '' and not args.gcStore and args.list == [] and args.verify == [] and args.unpack == [] and args.daemon is None:
         parser.print_help()
         return 1
     
-    for tid in args.info:
-        get_info(tid.lower())
+    cdnsp.options.update(nspRepack=args.repack, workers=args.workers, direct=args.direct, reflink=args.reflink, **segOpts)
+    cdnsp.configure(args.maxConnections, args.limit, args.metrics, args.prometheus, args.progress, args.syncCatalog, args.adaptive)
+    
+    if args.daemon is not None:
+        return serve(cdnsp, args.daemon, args.titles)
+    
+    failed = 0
+    if args.syncCatalog:
+        failed += sync_catalog(max(args.infoWorkers, 1))
+    
+    tids = [tid.lower() for tid in args.info]
+    if args.infoFile != '':
+        tids += read_tids(args.infoFile)
+    if tids != [] and args.infoOut != '':
+        results = bulk_info(tids, max(args.infoWorkers, 1))
+        write_info(results, args.infoOut)
+        lookupFailed = sum(info['error'] is not None for info in results)
+        print('Looked up %s TitleIDs, %s failed. Results written to %s' % (len(results), lookupFailed, args.infoOut))
+        failed += lookupFailed
+    elif tids != []:
+        def show(info):
+            print('\n%s:' % info['tid'])
+            if info['error'] is not None:
+                print('\t%s' % info['error'])
+            else:
+                print_info(info)
+        results = bulk_info(tids, max(args.infoWorkers, 1), show)
+        failed += sum(info['error'] is not None for info in results)
     
     for game in args.games:
         try:
-            tid, ver, tkey = game.lower().split('-')
+            parts = game.lower().split('-')
+            if len(parts) not in (2, 3):
+                raise ValueError('should be formatted this way: TID-VER(-TKEY)!')
+            tid, ver, tkey = parts if len(parts) == 3 else parts + ['']
             if len(tid) != 16:
                 raise ValueError('TitleID %s is not a 16-digits hexadecimal number!' % tid)
-            if len(tkey) != 32:
+            if tkey != '' and len(tkey) != 32:
                 raise ValueError('Titlekey %s is not a 32-digits hexadecimal number!' % tkey)
-            get_info(tid)
-            download_game(tid, ver, tkey, nspRepack=args.repack)
-        except ValueError:
-            try:
-                tid, ver = game.lower().split('-')
-            except ValueError:
-                print('Incorrect game argument (%s): should be formatted this way: TID-VER(-TKEY)!' % game)
-                return 1
-                
-            if len(tid) != 16:
-                raise ValueError('TitleID %s is not a 16-digits hexadecimal number!' % tid)
-
-            get_info(tid)
-            download_game(tid, ver, nspRepack=args.repack)
+        except ValueError as e:
+            print('Incorrect game argument (%s): %s' % (game, e))
+            return 1
+        
+        try: # One title failing doesn't stop the others
+            name = get_info(tid)
+            if download_game(tid, ver, tkey, nspRepack=args.repack, workers=args.workers, direct=args.direct, reflink=args.reflink, name=name, **segOpts) is None:
+                failed += 1
+        except Exception as e:
+            print('\n%s failed: %s' % (tid, str(e) or type(e).__name__))
+            failed += 1
         
     for ver in args.sysupdates:
-        download_sysupdate(ver)
+        try: # One system update failing doesn't stop the others
+            download_sysupdate(ver, workers=args.workers, packTypes=packTypes, **segOpts)
+        except Exception as e:
+            print('\nSystem update %s failed: %s' % (ver, str(e) or type(e).__name__))
+            failed += 1
+    
+    if args.batch != '':
+        failed += run_batch(args.batch, args.results, args.titles, args.repack, args.workers, direct=args.direct, reflink=args.reflink, **segOpts)
+    
+    if args.mirror != '':
+        failed += run_mirror(args.mirror, args.mirrorState, args.results, args.titles, args.repack, args.workers, direct=args.direct,
+                             reflink=args.reflink, packTypes=packTypes, **segOpts)
+    
+    if args.extract != []:
+        sections = [section.strip() for section in args.sections.lower().split(',') if section.strip()]
+        for section in sections:
+            if section not in ncaSections:
+                parser.error('unknown section %s, expected some of %s' % (section, ', '.join(ncaSections)))
+        extract_NCAs(args.extract, sections, max(args.extractWorkers, 1))
+    
+    if args.list != []:
+        failed += list_NSPs(args.list)
+    if args.verify != []:
+        failed += verify_NSPs(args.verify, max(args.nspWorkers, 1))
+    if args.unpack != []:
+        failed += unpack_NSPs(args.unpack, max(args.nspWorkers, 1))
+    
+    if args.gcStore:
+        gc_store()
         
     print('Done!')
-    return 0
+    return 1 if failed else 0
 
 if __name__ == '__main__':
     urllib3.disable_warnings()
-
-    try:
-        from tqdm import tqdm
-        tqdmProgBar = True
-    except ImportError:
-        tqdmProgBar = False
-        print('Install the tqdm library for better-looking progress bars! (pip install tqdm)')
-        
-    configPath = os.path.join(os.path.dirname(__file__), 'CDNSPconfig.json')
-    hactoolPath, keysPath, NXclientPath, ShopNPath, reg, fw, did, env = load_config(configPath)
-    
-    if keysPath != '':
-        keysArg = ' -k "%s"' % keysPath
-    else:
-        keysArg = ''
     
-    
-    sys.exit(main())
+    cdnsp = client()
+    cdnsp.install()
+    try:
+        sys.exit(main(cdnsp))
+    finally:
+        cdnsp.close()
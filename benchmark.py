@@ -0,0 +1,659 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Purpose: Offline benchmarks for CDNSP. Compares the NSP repack and header code against the
+#          original implementations, and runs the download code against a local mock CDN
+#          (atum/tagaya/shogun/sun) with optional latency, bandwidth throttling and dropped
+#          connections, so performance changes can be checked without the real CDN.
+# Usage:   python3 benchmark.py [--size MB] [--files N] [--entries N] [--dir PATH] [--only LIST]
+#                               [--nca-size MB] [--ncas N] [--latency MS] [--bandwidth MB/S] [--drop RATE]
+#                               [--capacity N]
+
+import os, sys
+import re
+import json
+import time
+import random
+import socket
+import shutil
+import argparse
+import tempfile
+import threading
+from struct import pack as pk
+from hashlib import sha256
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import CDNSP
+
+benchmarks = ['repack', 'header', 'cnmt', 'verify', 'download', 'title', 'adaptive', 'failover', 'info']
+
+def legacy_gen_header(filesNb, files):
+    # nsp.gen_header as it was before the single-buffer rewrite, kept as the baseline
+    stringTable = '\x00'.join(os.path.basename(file) for file in files)
+    headerSize = 0x10 + (filesNb)*0x18 + len(stringTable)
+    remainder = 0x10 - headerSize%0x10
+    
+    fileSizes = [os.path.getsize(file) for file in files]
+    fileOffsets = [sum(fileSizes[:n]) for n in range(filesNb)]
+    
+    fileNamesLengths = [len(os.path.basename(file))+1 for file in files]
+    stringTableOffsets = [sum(fileNamesLengths[:n]) for n in range(filesNb)]
+    
+    header =  b''
+    header += b'PFS0'
+    header += pk('<I', filesNb)
+    header += pk('<I', len(stringTable)+remainder)
+    header += b'\x00\x00\x00\x00'
+    for n in range(filesNb):
+        header += pk('<Q', fileOffsets[n])
+        header += pk('<Q', fileSizes[n])
+        header += pk('<I', stringTableOffsets[n])
+        header += b'\x00\x00\x00\x00'
+    header += stringTable.encode()
+    header += remainder * b'\x00'
+    
+    return header
+
+def legacy_repack(outPath, files):
+    # nsp.repack as it was before the kernel copy path, kept as the baseline
+    hd = legacy_gen_header(len(files), files)
+    with open(outPath, 'wb') as outf:
+        outf.write(hd)
+        for f in files:
+            with open(f, 'rb') as inf:
+                while True:
+                    buf = inf.read(4096)
+                    if not buf:
+                        break
+                    outf.write(buf)
+
+def make_files(dir, total, count):
+    files = []
+    chunk = os.urandom(0x100000)
+    for n in range(count):
+        fPath = os.path.join(dir, '%032x.nca' % n)
+        with open(fPath, 'wb') as f:
+            left = total // count
+            while left > 0:
+                f.write(chunk[:min(left, len(chunk))])
+                left -= len(chunk)
+        files.append(fPath)
+    return files
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+def quiet(func, *args, **kwargs):
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return func(*args, **kwargs)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def report(name, seconds, nbytes=None, requests=None):
+    if nbytes is None:
+        line = '%-34s %10.3f ms' % (name, seconds * 1000)
+    elif requests is None:
+        line = '%-34s %10.3f s  %8.3f GB/s' % (name, seconds, nbytes / seconds / 1e9)
+    else:
+        line = '%-34s %10.3f s  %8.1f MB/s' % (name, seconds, nbytes / seconds / 1e6)
+    if requests is not None:
+        line += '  %5s requests' % requests
+    print(line)
+
+def bench_repack(dir, size, count):
+    print('\nnsp.repack, %s in %s files:' % (CDNSP.bytes2human(size), count))
+    files = make_files(dir, size, count)
+    total = sum(os.path.getsize(f) for f in files)
+    out = os.path.join(dir, 'out.nsp')
+    
+    report('legacy 4096-byte loop', timed(legacy_repack, out, files), total)
+    os.remove(out)
+    report('copy_file_range/sendfile', timed(quiet, CDNSP.nsp(out, files).repack), total)
+    os.remove(out)
+    report('reflink (with fallback)', timed(quiet, CDNSP.nsp(out, files).repack, True), total)
+    os.remove(out)
+    
+    for f in files:
+        os.remove(f)
+
+def legacy_verify(fPath):
+    # Reads every entry back through a 1 MB buffer and hashes it, one at a time, as the baseline
+    NSP = CDNSP.nsp_reader(fPath)
+    entries = NSP.entries
+    contents = NSP.contents()
+    NSP.close()
+    with open(fPath, 'rb') as f:
+        for name in contents:
+            offset, size = entries[name]
+            hash = sha256()
+            f.seek(offset)
+            while size > 0:
+                buf = f.read(min(size, 0x100000))
+                hash.update(buf)
+                size -= len(buf)
+            assert hash.hexdigest() == contents[name][2]
+
+def warm(fPath):
+    # verify_NSPs drops what it hashed from the page cache, every variant starts from a cached file
+    with open(fPath, 'rb') as f:
+        while f.read(0x800000):
+            pass
+
+def bench_verify(dir, size, count):
+    workers = os.cpu_count() or 1
+    print('\nverify_NSPs, %s in %s NCAs:' % (CDNSP.bytes2human(size), count))
+    files = make_files(dir, size, count)
+    xmlPath = os.path.join(dir, '%032x.cnmt.xml' % count)
+    with open(xmlPath, 'w') as f:
+        f.write('<ContentMeta>%s</ContentMeta>' % ''.join(
+                '<Content><Type>Data</Type><Id>%s</Id><Size>%s</Size><Hash>%s</Hash></Content>'
+                % (os.path.basename(file).split('.')[0], os.path.getsize(file), CDNSP.file_sha256(file)) for file in files))
+    out = os.path.join(dir, 'verify.nsp')
+    quiet(CDNSP.nsp(out, files + [xmlPath]).repack)
+    for file in files + [xmlPath]:
+        os.remove(file)
+    total = os.path.getsize(out)
+    
+    warm(out)
+    report('read + hash, one entry at a time', timed(legacy_verify, out), total)
+    for name, n in [('mmap, 1 worker', 1), ('mmap, %s workers' % workers, workers)][:2 if workers > 1 else 1]:
+        warm(out)
+        report(name, timed(quiet, CDNSP.verify_NSPs, [out], n), total)
+    os.remove(out)
+
+def bench_gen_header(dir, count):
+    print('\nnsp.gen_header, %s entries:' % count)
+    files = make_files(dir, 0, count)
+    NSP = CDNSP.nsp(os.path.join(dir, 'out.nsp'), files)
+    sizes = [os.path.getsize(f) for f in files]
+    assert NSP.gen_header(count, files) == legacy_gen_header(count, files)
+    
+    report('legacy sum()/bytes +=', timed(legacy_gen_header, count, files))
+    report('preallocated buffer', timed(NSP.gen_header, count, files, sizes))
+    
+    for f in files:
+        os.remove(f)
+
+class mock_handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True # Like nginx's tcp_nodelay, headers and body are written separately
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def version_string(self):
+        return self.serverName
+    
+    def do_HEAD(self):
+        self.reply(False)
+        
+    def do_GET(self):
+        self.reply(True)
+    
+    def reply(self, body):
+        cdn = self.server
+        with cdn.lock:
+            cdn.requests += 1
+        self.serverName = 'openresty/1.9.7.4'
+        if cdn.latency:
+            time.sleep(cdn.latency)
+        
+        url = urlsplit(self.path)
+        parts = url.path.strip('/').split('/')
+        headers = {}
+        data = None
+        if parts[0] == 't' and len(parts) == 4:               # atum(n) /t/a|s/<tid>/<ver>
+            id = cdn.titles.get((parts[2], parts[3]))
+            if id is not None:
+                data = b''
+                headers['X-Nintendo-Content-ID'] = id
+        elif parts[0] == 'c' and len(parts) == 3:             # atum(n) /c/a|c|s/<content ID>
+            data = cdn.contents.get(parts[2])
+        elif parts[:4] == ['shogun', 'v1', 'contents', 'ids']:
+            tid = parse_qs(url.query).get('title_ids', [''])[0]
+            pairs = [{'id': cdn.shogun[tid][0], 'title_id': tid}] if tid in cdn.shogun else []
+            data = json.dumps({'id_pairs': pairs}).encode()
+        elif parts[:3] == ['shogun', 'v1', 'titles'] and len(parts) == 4:
+            for tid, (nsuid, name, size) in cdn.shogun.items():
+                if str(nsuid) == parts[3]:
+                    data = json.dumps({'id': nsuid, 'formal_name': name, 'total_rom_size': size}).encode()
+        else:                                                 # tagaya versionlist, sun system_update_meta
+            data = cdn.static.get(url.path)
+        
+        if data is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        
+        start = 0
+        end = len(data) - 1
+        status = 200
+        m = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if m is not None:
+            start = int(m.group(1))
+            end = min(int(m.group(2)), end) if m.group(2) else end
+            if start >= len(data):
+                # Out of range requests are answered by a different server, which is what download_file looks for
+                self.serverName = 'nginx'
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+        
+        counted = body and parts[0] == 'c' # Only content downloads count against the capacity
+        if counted:
+            with cdn.lock:
+                refused = cdn.capacity and cdn.active >= cdn.capacity
+                if refused:
+                    cdn.refused += 1
+                else:
+                    cdn.active += 1
+            if refused: # Like an overloaded edge
+                self.send_response(503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+        
+        self.send_response(status)
+        self.send_header('Content-Length', str(end - start + 1))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, end, len(data)))
+        for key in headers:
+            self.send_header(key, headers[key])
+        self.end_headers()
+        if body:
+            try:
+                self.send_body(memoryview(data)[start:end+1])
+            finally:
+                if counted:
+                    with cdn.lock:
+                        cdn.active -= 1
+    
+    def send_body(self, view):
+        cdn = self.server
+        dropAt = len(view)
+        if cdn.dropRate and len(view) > 1 and random.random() < cdn.dropRate:
+            dropAt = random.randrange(len(view))
+        
+        sent = 0
+        begin = time.monotonic()
+        while sent < len(view):
+            if sent >= dropAt:
+                with cdn.lock:
+                    cdn.dropped += 1
+                self.close_connection = True
+                self.connection.shutdown(socket.SHUT_RDWR)
+                return
+            n = min(0x10000, len(view) - sent, dropAt - sent)
+            self.wfile.write(view[sent:sent+n])
+            sent += n
+            with cdn.lock:
+                cdn.sent += n
+            if cdn.bandwidth: # Per connection, like a congested CDN edge
+                delay = sent / cdn.bandwidth - (time.monotonic() - begin)
+                if delay > 0:
+                    time.sleep(delay)
+
+class mock_cdn(ThreadingHTTPServer):
+    # Serves titles, contents and metadata the way atum/tagaya/shogun/sun do, on a local port
+    daemon_threads = True
+    
+    def __init__(self, latency=0, bandwidth=0, dropRate=0, capacity=0):
+        super().__init__(('127.0.0.1', 0), mock_handler)
+        self.latency = latency     # Seconds added to every request
+        self.bandwidth = bandwidth # Bytes per second per connection, 0 for no limit
+        self.dropRate = dropRate   # Chance of a body being cut short
+        self.capacity = capacity   # Bodies sent at once, further GETs get a 503, 0 for no limit
+        self.titles = {}           # (TitleID, version) -> CNMT content ID
+        self.contents = {}         # Content ID -> data
+        self.shogun = {}           # Base TitleID -> (nsuid, name, size)
+        self.static = {}           # Path -> data
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.sent = 0
+        self.dropped = 0
+        self.active = 0
+        self.refused = 0
+        self.url = 'http://127.0.0.1:%s' % self.server_address[1]
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+    
+    def handle_error(self, request, client_address):
+        pass # Clients hanging up on dropped or aborted downloads
+    
+    def endpoints(self, env):
+        hosts = ['atum.hac.%s.d4c.nintendo.net', 'atumn.hac.%s.d4c.nintendo.net', 'sun.hac.%s.d4c.nintendo.net',
+                 'tagaya.hac.%s.eshop.nintendo.net', 'bugyo.hac.%s.eshop.nintendo.net']
+        return {host % env: self.url for host in hosts}
+
+def encrypt(cipher, data):
+    encryptor = cipher.encryptor()
+    return encryptor.update(data) + encryptor.finalize()
+
+def make_pfs0(files):
+    names = b''.join(name.encode() + b'\x00' for name in files)
+    names += b'\x00' * (-len(names) % 0x10)
+    header = b'PFS0' + pk('<III', len(files), len(names), 0)
+    offset = 0
+    nameOffset = 0
+    for name in files:
+        header += pk('<QQII', offset, len(files[name]), nameOffset, 0)
+        offset += len(files[name])
+        nameOffset += len(name) + 1
+    return header + names + b''.join(files.values())
+
+def make_cnmt(tid, ver, type, contents):
+    # contents are (SHA-256, NCA ID, size, content type) tuples
+    extHeader = pk('<QQ', 0, 0) if type in [0x80, 0x81, 0x82] else b''
+    data = pk('<QIB1xHHH4xQ', tid, ver, type, len(extHeader), len(contents), 0, 0) + extHeader
+    for hash, ncaID, size, contentType in contents:
+        data += hash + ncaID + pk('<Q', size)[:6] + pk('<Bx', contentType)
+    return data + os.urandom(0x20)
+
+def make_nca(keys, files, keyGen=5):
+    # Builds a CNMT-style NCA with a single AES-CTR PFS0 section, encrypted like the real ones
+    Cipher, algorithms, modes = CDNSP.Cipher, CDNSP.algorithms, CDNSP.modes
+    keyArea = os.urandom(0x40)
+    section = make_pfs0(files)
+    section += b'\x00' * (-len(section) % 0x200)
+    ctr = os.urandom(8)
+    data = encrypt(Cipher(algorithms.AES(keyArea[0x20:0x30]), modes.CTR(ctr[::-1] + pk('>Q', 0xC00 >> 4))), section)
+    
+    header = bytearray(0xC00)
+    header[0x200:0x204] = b'NCA3'
+    header[0x205] = 1 # Meta
+    header[0x220] = keyGen
+    pk_into = __import__('struct').pack_into
+    pk_into('<Q', header, 0x208, 0xC00 + len(section))
+    pk_into('<II', header, 0x240, 0xC00 // 0x200, (0xC00 + len(section)) // 0x200)
+    header[0x300:0x340] = encrypt(Cipher(algorithms.AES(keys['key_area_key_application_%02x' % (keyGen-1)]), modes.ECB()), keyArea)
+    header[0x403] = 2 # PFS0
+    header[0x404] = 3 # AES-CTR
+    pk_into('<QQ', header, 0x440, 0, len(make_pfs0(files)))
+    header[0x540:0x548] = ctr
+    
+    encHeader = b''.join(encrypt(Cipher(algorithms.AES(keys['header_key']), modes.XTS(n.to_bytes(16, 'big'))), bytes(header[n*0x200:(n+1)*0x200]))
+                         for n in range(6))
+    return encHeader + data
+
+def add_title(cdn, keys, tid, ver, sizes):
+    # Random NCAs of the given sizes under a CNMT for tid v(ver), returns the total size
+    contents = []
+    for n, size in enumerate(sizes):
+        data = os.urandom(size)
+        hash = sha256(data).digest()
+        cdn.contents[hash[:16].hex()] = data
+        contents.append((hash, hash[:16], size, 1 if n == 0 else 2))
+    type = 0x81 if tid.endswith('800') else 0x80
+    data = make_nca(keys, {'%s_%s.cnmt' % ('Patch' if type == 0x81 else 'Application', tid): make_cnmt(int(tid, 16), ver, type, contents)})
+    cdn.contents[sha256(data).hexdigest()[:32]] = data
+    cdn.titles[(tid, str(ver))] = sha256(data).hexdigest()[:32]
+    return sum(sizes) + len(data)
+
+def setup_cdnsp(dir, cdn, keys):
+    # Points CDNSP's globals at the mock CDN, as its __main__ block would from the config file
+    root = os.path.dirname(os.path.abspath(CDNSP.__file__))
+    paths = CDNSP.load_config(os.path.join(root, 'CDNSPconfig.json'))
+    names = ['hactoolPath', 'keysPath', 'NXclientPath', 'ShopNPath', 'reg', 'fw', 'did', 'env', 'config']
+    for name, value in zip(names, paths):
+        if name.endswith('Path') and not os.path.isabs(value):
+            value = os.path.join(root, value)
+        setattr(CDNSP, name, value)
+    
+    CDNSP.keysPath = os.path.join(dir, 'keys.txt')
+    with open(CDNSP.keysPath, 'w') as f:
+        for key in keys:
+            f.write('%s = %s\n' % (key, keys[key].hex()))
+    CDNSP.config['Network']['Endpoints'] = cdn.endpoints(CDNSP.env)
+    CDNSP.config['Cache']['Path'] = os.path.join(dir, 'cache')
+    CDNSP.config['Store']['Enabled'] = False
+
+def retried(cdns, func, *args, **kwargs):
+    # Reruns a download the mock CDNs broke on purpose (dropped or refused connections), as a user would.
+    # Any other failure is a bug and is raised right away, so is one that keeps happening.
+    attempts = 1
+    while True:
+        broken = sum(cdn.dropped + cdn.refused for cdn in cdns)
+        try:
+            quiet(func, *args, **kwargs)
+            return attempts
+        except (OSError, ValueError, CDNSP.requests.exceptions.RequestException) as e:
+            if sum(cdn.dropped + cdn.refused for cdn in cdns) == broken or attempts >= 10:
+                raise
+            print('\t%s failed after the mock CDN broke connections, retrying: %s' % (func.__name__, str(e) or type(e).__name__))
+            attempts += 1
+
+def attempted(name, attempts):
+    return name if attempts == 1 else '%s (%s attempts)' % (name, attempts)
+
+def bench_cnmt(dir, count):
+    print('\ncnmt.parse, %s content records:' % count)
+    contents = [(os.urandom(32), os.urandom(16), random.randrange(0x100000000), random.randrange(6)) for n in range(count)]
+    data = make_cnmt(0x0100000000001000, 0, 0x80, contents)
+    fPath = os.path.join(dir, 'Application_0100000000001000.cnmt')
+    with open(fPath, 'wb') as f:
+        f.write(data)
+    
+    rounds = 100
+    start = time.perf_counter()
+    for n in range(rounds):
+        CNMT = CDNSP.cnmt(fPath)
+        for type in CNMT.ncaTypes.values():
+            CNMT.parse(type)
+    report('read + parse every type', (time.perf_counter() - start) / rounds)
+    CNMT = CDNSP.cnmt(fPath, data)
+    report('parse one type', timed(CNMT.parse, 'Program'))
+    os.remove(fPath)
+
+def bench_download(dir, cdn, size, segments):
+    print('\ndownload_file, one %s NCA:' % CDNSP.bytes2human(size))
+    data = os.urandom(size)
+    id = sha256(data).hexdigest()
+    cdn.contents[id[:32]] = data
+    url = 'https://atum.hac.%s.d4c.nintendo.net/c/c/%s?device_id=%s' % (CDNSP.env, id[:32], CDNSP.did)
+    fPath = os.path.join(dir, '%s.nca' % id[:32])
+    
+    for name, count in [('single stream', 1), ('%s segments' % segments, segments)]:
+        requests = cdn.requests
+        start = time.perf_counter()
+        attempts = retried([cdn], CDNSP.download_file, url, fPath, segments=count, segmentSize=max(size // (2*count), 1), expHash=id)
+        report(attempted(name, attempts),
+               time.perf_counter() - start, size, cdn.requests - requests)
+        os.remove(fPath)
+    del cdn.contents[id[:32]]
+
+def bench_title(dir, cdn, keys, size, count, workers):
+    print('\ndownload_title, %s NCAs of %s:' % (count, CDNSP.bytes2human(size // count)))
+    tid = '0100000000001000'
+    total = add_title(cdn, keys, tid, 0, [size // count] * count)
+    
+    for name, n in [('1 worker', 1), ('%s workers' % workers, workers)]:
+        gameDir = os.path.join(dir, tid)
+        os.makedirs(gameDir)
+        requests = cdn.requests
+        start = time.perf_counter()
+        attempts = retried([cdn], CDNSP.download_title, gameDir, tid, '0', workers=n)
+        report(attempted(name, attempts),
+               time.perf_counter() - start, total, cdn.requests - requests)
+        shutil.rmtree(gameDir)
+
+def bench_adaptive(dir, cdn, keys, size, count, capacity):
+    # Every NCA is split in 4, so the title asks for 4*count connections. The mock CDN only serves capacity
+    # of them at 2 MB/s each and refuses the others, so capacity is the best fixed number of connections.
+    print('\nadaptive connections, %s NCAs of %s, mock CDN serving %s connections at 2 MB/s:' % (count, CDNSP.bytes2human(size // count), capacity))
+    tid = '0100000000003000'
+    total = add_title(cdn, keys, tid, 0, [size // count] * count)
+    saved = cdn.bandwidth, cdn.capacity, CDNSP.connSlots, CDNSP.adaptive_limiter.interval
+    cdn.bandwidth, cdn.capacity = 2e6, capacity
+    CDNSP.adaptive_limiter.interval = 0.5 # Decisions come 4 times as often to keep the runs short
+    try:
+        for name, slots in [('4 connections', threading.BoundedSemaphore(4)), ('%s connections' % (4*count), None),
+                            ('adaptive, up to %s' % (4*count), CDNSP.adaptive_limiter(4*count))]:
+            CDNSP.connSlots = slots
+            gameDir = os.path.join(dir, tid)
+            os.makedirs(gameDir)
+            requests = cdn.requests
+            refused = cdn.refused
+            start = time.perf_counter()
+            attempts = retried([cdn], CDNSP.download_title, gameDir, tid, '0', workers=count, segments=4, segmentSize=max(size // count // 4, 1))
+            if isinstance(slots, CDNSP.adaptive_limiter):
+                name += ', ended at %s' % slots.limit
+            report(attempted('%s, %s refused' % (name, cdn.refused - refused), attempts),
+                   time.perf_counter() - start, total, cdn.requests - requests)
+            shutil.rmtree(gameDir)
+    finally:
+        cdn.bandwidth, cdn.capacity, CDNSP.connSlots, CDNSP.adaptive_limiter.interval = saved
+
+def bench_failover(dir, cdn, keys, size, count):
+    # A second mock CDN stands in for a bad edge: slow to answer, 4 MB/s per connection and dropping half of the
+    # bodies. It serves the title alone, then along with the first mock CDN as an equivalent host.
+    print('\nfailover, %s NCAs of %s, edge adding 200 ms, serving 4 MB/s per connection and dropping half of the bodies:'
+          % (count, CDNSP.bytes2human(size // count)))
+    tid = '0100000000004000'
+    total = add_title(cdn, keys, tid, 0, [size // count] * count)
+    edge = mock_cdn(0.2, 4e6, 0.5)
+    edge.titles, edge.contents = cdn.titles, cdn.contents
+    host = 'atum.hac.%s.d4c.nintendo.net' % CDNSP.env
+    saved = dict(CDNSP.config['Network']['Mirrors'])
+    try:
+        for name, bases in [('edge only', [edge.url]), ('edge + mirror', [edge.url, cdn.url])]:
+            CDNSP.config['Network']['Mirrors'][host] = bases
+            CDNSP.hostPools.clear()
+            gameDir = os.path.join(dir, tid)
+            os.makedirs(gameDir)
+            requests = cdn.requests + edge.requests
+            sent = cdn.sent, edge.sent
+            start = time.perf_counter()
+            attempts = retried([cdn, edge], CDNSP.download_title, gameDir, tid, '0', workers=count, segments=4, segmentSize=max(size // count // 4, 1))
+            served = edge.sent - sent[1], cdn.sent - sent[0]
+            report(attempted('%s, %.0f%% from the edge' % (name, 100.0 * served[0] / max(1, sum(served))), attempts),
+                   time.perf_counter() - start, total, cdn.requests + edge.requests - requests)
+            shutil.rmtree(gameDir)
+    finally:
+        CDNSP.config['Network']['Mirrors'] = saved
+        CDNSP.hostPools.clear()
+        edge.shutdown()
+
+def bench_info(dir, cdn):
+    print('\nget_info:')
+    tid = '0100000000002000'
+    cdn.shogun[tid] = (70010000000001, 'Benchmark Title', 0x40000000)
+    cdn.static['/tagaya/hac_versionlist'] = json.dumps({'titles': [{'id': '%016x' % (0x0100000000000800 + (n << 12)), 'version': 0x10000 * (n % 8)}
+                                                                   for n in range(20000)]}).encode()
+    
+    for name in ['cold cache', 'warm cache']:
+        requests = cdn.requests
+        start = time.perf_counter()
+        attempts = retried([cdn], CDNSP.get_info, tid)
+        report(attempted(name, attempts),
+               time.perf_counter() - start, requests=cdn.requests - requests)
+    
+    CDNSP.config['Cache']['Enabled'] = False
+    requests = cdn.requests
+    start = time.perf_counter()
+    attempts = retried([cdn], CDNSP.get_info, tid)
+    report(attempted('cache disabled', attempts),
+           time.perf_counter() - start, requests=cdn.requests - requests)
+    
+    CDNSP.config['Cache']['Enabled'] = True
+    
+    # Half of the TitleIDs are unknown to shogun, so every region gets asked about them.
+    # Each run looks up other TitleIDs, with only the versionlist already cached.
+    workers = CDNSP.config['Network']['PoolMaxSize']
+    for run, (name, n) in enumerate([('bulk_info, 200 TIDs, 1 worker', 1), ('bulk_info, 200 TIDs, %s workers' % workers, workers)]):
+        tids = ['%016x' % (0x0100000000010000 + ((run*200 + i) << 13)) for i in range(200)]
+        for i, bulkTid in enumerate(tids[::2]):
+            cdn.shogun[bulkTid] = (70010000010000 + run*200 + i, 'Bulk Title %s' % i, 0x10000000)
+        requests = cdn.requests
+        start = time.perf_counter()
+        results = CDNSP.bulk_info(tids, n)
+        report('%s (%s failed)' % (name, sum(info['error'] is not None for info in results)),
+               time.perf_counter() - start, requests=cdn.requests - requests)
+    
+    # A 1000 games versionlist synced into the catalog, then looked up from the warm cache and from the catalog
+    games = ['%016x' % (0x0100000001000000 + (n << 13)) for n in range(1000)]
+    for n, game in enumerate(games):
+        cdn.shogun[game] = (70010000100000 + n, 'Catalog Title %s' % n, 0x10000000)
+    cdn.static['/tagaya/hac_versionlist'] = json.dumps({'titles': [{'id': '%s800' % game[:-3], 'version': 0x10000} for game in games]}).encode()
+    catalog = CDNSP.title_catalog(os.path.join(dir, 'catalog.db'))
+    CDNSP.titleCatalog = catalog
+    try:
+        for name in ['sync_catalog, 1000 games', 'sync_catalog, nothing changed']:
+            requests = cdn.requests
+            start = time.perf_counter()
+            quiet(CDNSP.sync_catalog, workers)
+            report(name, time.perf_counter() - start, requests=cdn.requests - requests)
+        
+        for name in ['1000 lookups, warm cache', '1000 lookups, catalog']:
+            CDNSP.titleCatalog = catalog if name.endswith('catalog') else None
+            requests = cdn.requests
+            start = time.perf_counter()
+            for game in games:
+                CDNSP.lookup_title(game)
+            report(name, time.perf_counter() - start, requests=cdn.requests - requests)
+    finally:
+        catalog.close()
+        CDNSP.titleCatalog = None
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline CDNSP benchmarks')
+    parser.add_argument('--size', type=int, default=1024, metavar='MB', help='total data repacked and verified (default: %(default)s)')
+    parser.add_argument('--files', type=int, default=8, metavar='N', help='number of NCAs repacked and verified (default: %(default)s)')
+    parser.add_argument('--entries', type=int, default=5000, metavar='N', help='entries in the gen_header benchmark (default: %(default)s)')
+    parser.add_argument('--dir', default=None, metavar='PATH', help='scratch directory, on the filesystem to measure')
+    parser.add_argument('--only', default=','.join(benchmarks), metavar='LIST', help='benchmarks to run (default: %(default)s)')
+    parser.add_argument('--nca-size', type=int, default=64, metavar='MB', help='data downloaded per download benchmark (default: %(default)s)')
+    parser.add_argument('--ncas', type=int, default=8, metavar='N', help='NCAs in the title benchmark, also used as -S and -j (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0, metavar='MS', help='latency the mock CDN adds to every request (default: %(default)s)')
+    parser.add_argument('--bandwidth', type=float, default=0, metavar='MB/S', help='mock CDN bandwidth per connection, 0 for no limit (default: %(default)s)')
+    parser.add_argument('--drop', type=float, default=0, metavar='RATE', help='chance of the mock CDN dropping a connection mid-body (default: %(default)s)')
+    parser.add_argument('--capacity', type=int, default=8, metavar='N', help='connections the mock CDN serves at once in the adaptive benchmark (default: %(default)s)')
+    args = parser.parse_args()
+    
+    only = [name.strip() for name in args.only.split(',') if name.strip()]
+    for name in only:
+        if name not in benchmarks:
+            parser.error('unknown benchmark %s, expected some of %s' % (name, ', '.join(benchmarks)))
+    if CDNSP.Cipher is None and set(only) & set(['download', 'title', 'adaptive', 'failover', 'info']):
+        print('The mock CDN benchmarks need the cryptography library, skipping them.')
+        only = [name for name in only if name not in ['download', 'title', 'adaptive', 'failover', 'info']]
+    
+    dir = tempfile.mkdtemp(prefix='cdnsp-bench-', dir=args.dir)
+    cdn = mock_cdn(args.latency / 1000, args.bandwidth * 1e6, args.drop)
+    keys = {'header_key': os.urandom(32), 'key_area_key_application_04': os.urandom(16)}
+    setup_cdnsp(dir, cdn, keys)
+    try:
+        if 'repack' in only:
+            bench_repack(dir, args.size * 0x100000, args.files)
+        if 'header' in only:
+            bench_gen_header(dir, args.entries)
+        if 'cnmt' in only:
+            bench_cnmt(dir, args.entries)
+        if 'verify' in only:
+            bench_verify(dir, args.size * 0x100000, args.files)
+        if 'download' in only:
+            bench_download(dir, cdn, args.nca_size * 0x100000, args.ncas)
+        if 'title' in only:
+            bench_title(dir, cdn, keys, args.nca_size * 0x100000, args.ncas, args.ncas)
+        if 'adaptive' in only:
+            bench_adaptive(dir, cdn, keys, args.nca_size * 0x100000, args.ncas, args.capacity)
+        if 'failover' in only:
+            bench_failover(dir, cdn, keys, args.nca_size * 0x100000, args.ncas)
+        if 'info' in only:
+            bench_info(dir, cdn)
+    finally:
+        cdn.shutdown()
+        shutil.rmtree(dir)
+    if cdn.dropped:
+        print('\nThe mock CDN dropped %s connections.' % cdn.dropped)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
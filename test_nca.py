@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Purpose: Checks CDNSP's in-process NCA decryption and key derivation against vectors built from
+#          synthetic keys. The encryption here only uses raw AES-ECB and spells out hactool's
+#          conventions (big-endian sector tweak, reversed section CTR followed by the offset >> 4)
+#          so a convention error in CDNSP can't cancel out against the same error in the encryptor.
+# Usage:   python3 -m unittest test_nca   (or python3 -m pytest test_nca.py)
+
+import os
+import tempfile
+import unittest
+from hashlib import sha256
+from struct import pack as pk, pack_into as pk_into
+
+import CDNSP
+
+def ecb(key, data, decrypt=False):
+    c = CDNSP.Cipher(CDNSP.algorithms.AES(key), CDNSP.modes.ECB())
+    c = c.decryptor() if decrypt else c.encryptor()
+    return c.update(data) + c.finalize()
+
+def gf_double(t):
+    # Multiplies the XTS tweak by x in GF(2^128), little-endian as in IEEE 1619
+    n = int.from_bytes(t, 'little') << 1
+    if n >> 128:
+        n = (n ^ 0x87) & ((1 << 128) - 1)
+    return n.to_bytes(16, 'little')
+
+def xts_encrypt(key, data, sector, sectorSize=0x200):
+    out = b''
+    for s in range(0, len(data), sectorSize):
+        # hactool's get_nintendo_tweak: the sector number, big-endian over the 16 bytes
+        t = ecb(key[0x10:], (sector + s//sectorSize).to_bytes(16, 'big'))
+        for b in range(s, s+sectorSize, 0x10):
+            block = bytes(x ^ y for x, y in zip(data[b:b+0x10], t))
+            out += bytes(x ^ y for x, y in zip(ecb(key[:0x10], block), t))
+            t = gf_double(t)
+    return out
+
+def ctr_crypt(key, sectionCtr, offset, data):
+    # hactool's nca_update_ctr: the section CTR byte-reversed, then offset >> 4 big-endian
+    out = b''
+    for b in range(0, len(data), 0x10):
+        counter = sectionCtr[::-1] + pk('>Q', (offset + b) >> 4)
+        out += bytes(x ^ y for x, y in zip(data[b:b+0x10], ecb(key, counter)))
+    return out
+
+KEYS = {'master_key_04':                  bytes(range(0x10)),
+        'aes_kek_generation_source':      bytes(range(0x10, 0x20)),
+        'aes_key_generation_source':      bytes(range(0x20, 0x30)),
+        'key_area_key_application_source': bytes(range(0x30, 0x40)),
+        'header_key':                     bytes(range(0x40, 0x60))}
+
+class nca_test(unittest.TestCase):
+    def setUp(self):
+        if CDNSP.Cipher is None:
+            self.skipTest('the cryptography library is not installed')
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for name in os.listdir(self.dir):
+            os.remove(os.path.join(self.dir, name))
+        os.rmdir(self.dir)
+
+    def keys(self):
+        fPath = os.path.join(self.dir, 'keys.txt')
+        with open(fPath, 'w') as f:
+            for name in KEYS:
+                f.write('%s = %s\n' % (name, KEYS[name].hex()))
+        return CDNSP.load_keys(fPath)
+
+    def test_key_derivation(self):
+        # hactool's generate_kek: master key -> kek seed -> source -> key seed, each an AES-ECB decryption
+        kek = ecb(KEYS['master_key_04'], KEYS['aes_kek_generation_source'], True)
+        srcKek = ecb(kek, KEYS['key_area_key_application_source'], True)
+        expected = ecb(srcKek, KEYS['aes_key_generation_source'], True)
+        self.assertEqual(self.keys()['key_area_key_application_04'], expected)
+
+    def test_xts_tweak(self):
+        data = os.urandom(0x600)
+        self.assertEqual(CDNSP.aes_xts_decrypt(KEYS['header_key'], xts_encrypt(KEYS['header_key'], data, 0x1234), 0x1234), data)
+
+    def test_cnmt_nca(self):
+        keys = self.keys()
+        cnmt = os.urandom(0x1A0)
+        name = b'Application_0100000000001000.cnmt\x00'
+        names = name + b'\x00' * (-len(name) % 0x10)
+        pfs0 = b'PFS0' + pk('<III', 1, len(names), 0) + pk('<QQII', 0, len(cnmt), 0, 0) + names + cnmt
+        section = pfs0 + b'\x00' * (-len(pfs0) % 0x200)
+
+        keyArea = bytes(range(0x80, 0xC0))
+        sectionCtr = bytes.fromhex('0102030405060708')
+        header = bytearray(0xC00)
+        header[0x200:0x204] = b'NCA3'
+        header[0x205] = 1    # Meta
+        header[0x206] = 2    # Crypto type, the lower one of the two
+        header[0x220] = 5    # Crypto type 2, master key 04
+        pk_into('<Q', header, 0x208, 0xC00 + len(section))
+        pk_into('<II', header, 0x240, 0xC00 // 0x200, (0xC00 + len(section)) // 0x200)
+        header[0x300:0x340] = ecb(keys['key_area_key_application_04'], keyArea)
+        header[0x403] = 2    # PFS0
+        header[0x404] = 3    # AES-CTR
+        pk_into('<QQ', header, 0x440, 0, len(pfs0))
+        header[0x540:0x548] = sectionCtr
+
+        fPath = os.path.join(self.dir, 'vector.cnmt.nca')
+        with open(fPath, 'wb') as f:
+            f.write(xts_encrypt(KEYS['header_key'], bytes(header), 0))
+            f.write(ctr_crypt(keyArea[0x20:0x30], sectionCtr, 0xC00, section))
+
+        NCA = CDNSP.nca(fPath, keys)
+        self.assertEqual(bytes(NCA.header), bytes(header))
+        self.assertEqual(NCA.keyArea, keyArea)
+        self.assertEqual(NCA.pfs0(0), {'Application_0100000000001000.cnmt': cnmt})
+
+    def test_wrong_header_key(self):
+        fPath = os.path.join(self.dir, 'random.nca')
+        with open(fPath, 'wb') as f:
+            f.write(os.urandom(0xC00))
+        with self.assertRaises(ValueError):
+            CDNSP.nca(fPath, self.keys())
+
+if __name__ == '__main__':
+    unittest.main()